@@ -0,0 +1,257 @@
+"""
+Plain representation of an audio analysis, independent from where it comes from,
+and a local analysis backend calculating it from the audio.
+"""
+import numpy as np
+
+FFT_SIZE = 2048
+HOP_SIZE = 512
+MEL_BANDS = 40
+TIMBRE_SIZE = 12
+
+
+class Analysis(object):
+    """
+    Bars, beats, segments and tempo of a sound, with the same structure as
+    the analyses returned by the Echo Nest : lists of dicts with at least
+    `start` and `duration`, and a `timbre` for segments.
+    """
+
+    def __init__(self, bars, beats, segments, tempo):
+        self.bars = bars
+        self.beats = beats
+        self.segments = segments
+        self.tempo = tempo
+
+    @classmethod
+    def from_echonest(cls, echonest):
+        """
+        Copies the relevant data from an Echo Nest analysis. Attributes added
+        to the bars after the analysis are left out.
+        """
+        def timing(infos):
+            return {'start': infos['start'], 'duration': infos['duration'],
+                'confidence': infos.get('confidence')}
+        return cls(
+            bars=[timing(bar_infos) for bar_infos in echonest.bars],
+            beats=[timing(beat_infos) for beat_infos in echonest.beats],
+            segments=[dict(seg) for seg in echonest.segments],
+            tempo=echonest.tempo
+        )
+
+    @classmethod
+    def from_frames(cls, frames, sample_rate):
+        """
+        Analyses the audio `frames` locally. Beats are tracked on the spectral flux,
+        bars are groups of 4 beats, segments start at the onsets, and the timbre of
+        a segment is its 12 first mel-cepstral coefficients (in dB, so their
+        range is close to the one of the Echo Nest timbres).
+        """
+        frames = np.asarray(frames, dtype=float)
+        if frames.ndim > 1: frames = frames.mean(axis=1)
+        length = len(frames) / float(sample_rate)
+        frame_rate = sample_rate / float(HOP_SIZE)
+        log_mel = _log_mel_spectrogram(frames, sample_rate)
+        onsets = _onset_strength(log_mel)
+
+        tempo = _estimate_tempo(onsets, frame_rate)
+        beat_frames = _track_beats(onsets, frame_rate * 60 / tempo)
+        beat_times = _frame_times(beat_frames, sample_rate).tolist()
+        beats = [{'start': start, 'duration': end - start, 'confidence': confidence}
+            for start, end, confidence in zip(beat_times[:-1], beat_times[1:], _confidences(onsets, beat_frames))]
+
+        # Downbeats are the beats, out of 4, which are the loudest on average
+        loudness = log_mel.mean(axis=1)
+        phase = int(np.argmax([loudness[beat_frames[i::4]].mean() if len(beat_frames[i::4]) else -np.inf
+            for i in range(4)])) if len(beat_frames) else 0
+        bar_times = beat_times[phase::4]
+        bars = [{'start': start, 'duration': end - start, 'confidence': confidence}
+            for start, end, confidence in zip(bar_times[:-1], bar_times[1:], _confidences(onsets, beat_frames[phase::4]))]
+
+        # Segments cover the whole sound, from onset to onset. The flux of a frame is the rise
+        # of energy since the previous one, so segments start between the 2 frames. Otherwise
+        # they would start exactly on the beats, and no bar would be strictly inside a segment.
+        segment_frames = np.union1d([0], _pick_peaks(onsets, frame_rate))
+        segment_times = np.append(_frame_times(segment_frames - 0.5, sample_rate), length)
+        segment_times[0] = 0
+        segment_times = segment_times.tolist()
+        timbres = _cepstrum(np.add.reduceat(log_mel, segment_frames, axis=0)
+            / np.diff(np.append(segment_frames, len(log_mel)))[:, np.newaxis])
+        segments = [{'start': start, 'duration': end - start, 'confidence': confidence, 'timbre': timbre}
+            for start, end, confidence, timbre in zip(segment_times[:-1], segment_times[1:],
+                _confidences(onsets, segment_frames), timbres.tolist())]
+
+        return cls(bars=bars, beats=beats, segments=segments, tempo=tempo)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['bars'], data['beats'], data['segments'], data['tempo'])
+
+    def to_dict(self):
+        return {
+            'bars': self.bars,
+            'beats': self.beats,
+            'segments': self.segments,
+            'tempo': self.tempo
+        }
+
+    def slice(self, start, end):
+        """
+        Returns the analysis of the portion between `start` and `end` (in seconds),
+        with times relative to `start`. Bars and beats are kept if they are entirely
+        in the portion, segments are kept if they overlap it.
+        """
+        bars_starts, bars_ends = self._timings('bars')
+        beats_starts, beats_ends = self._timings('beats')
+        segments_starts, segments_ends = self._timings('segments')
+        def shifted(items, kept):
+            return [dict(items[i], start=items[i]['start'] - start) for i in np.flatnonzero(kept)]
+        return Analysis(
+            bars=shifted(self.bars, (bars_starts >= start) & (bars_ends <= end)),
+            beats=shifted(self.beats, (beats_starts >= start) & (beats_ends <= end)),
+            segments=shifted(self.segments, (segments_starts < end) & (segments_ends > start)),
+            tempo=self.tempo
+        )
+
+    def _timings(self, name):
+        """
+        Returns the arrays of starts and ends of the bars, beats or segments,
+        calculated once per analysis so that many slices can be taken cheaply.
+        """
+        timings = self.__dict__.setdefault('_timings_cache', {})
+        if name not in timings:
+            items = getattr(self, name)
+            starts = np.array([infos['start'] for infos in items], dtype=float)
+            durations = np.array([infos['duration'] for infos in items], dtype=float)
+            timings[name] = (starts, starts + durations)
+        return timings[name]
+
+
+def _log_mel_spectrogram(samples, sample_rate):
+    """
+    Returns the mel band energies (in dB) of the frames of `samples`, with shape (frames, `MEL_BANDS`).
+    """
+    samples = np.concatenate([samples, np.zeros(max(FFT_SIZE - len(samples), 0))])
+    frame_count = 1 + (len(samples) - FFT_SIZE) // HOP_SIZE
+    blocks = np.lib.stride_tricks.as_strided(samples, shape=(frame_count, FFT_SIZE),
+        strides=(samples.strides[0] * HOP_SIZE, samples.strides[0]))
+    power = np.abs(np.fft.rfft(blocks * np.hanning(FFT_SIZE), axis=1)) ** 2
+    log_mel = 10 * np.log10(np.dot(power, _mel_filters(sample_rate).T) + 1e-10)
+    # Limiting the dynamic range, so that the noise floor doesn't make onsets
+    return np.maximum(log_mel, log_mel.max() - 80)
+
+
+def _mel_filters(sample_rate, cache={}):
+    """
+    Returns the triangular mel filterbank for `sample_rate`, with shape (`MEL_BANDS`, FFT bins).
+    """
+    if sample_rate not in cache:
+        to_mel = lambda hz: 2595 * np.log10(1 + hz / 700.0)
+        to_hz = lambda mel: 700 * (10 ** (mel / 2595.0) - 1)
+        edges = to_hz(np.linspace(to_mel(0), to_mel(sample_rate / 2.0), MEL_BANDS + 2))
+        bins = np.linspace(0, sample_rate / 2.0, FFT_SIZE // 2 + 1)
+        lower, center, upper = edges[:-2, np.newaxis], edges[1:-1, np.newaxis], edges[2:, np.newaxis]
+        cache[sample_rate] = np.maximum(0, np.minimum((bins - lower) / (center - lower),
+            (upper - bins) / (upper - center)))
+    return cache[sample_rate]
+
+
+def _cepstrum(log_mel):
+    """
+    Returns the `TIMBRE_SIZE` first coefficients of the DCT-II of each row of `log_mel`.
+    """
+    bands = np.arange(MEL_BANDS)
+    dct = np.cos(np.pi / MEL_BANDS * (bands + 0.5) * np.arange(TIMBRE_SIZE)[:, np.newaxis])
+    dct *= np.sqrt(2.0 / MEL_BANDS)
+    dct[0] /= np.sqrt(2)
+    return np.dot(log_mel, dct.T)
+
+
+def _onset_strength(log_mel):
+    """
+    Spectral flux : the increase of energy between consecutive frames, summed over the bands.
+    """
+    flux = np.maximum(0, np.diff(log_mel, axis=0)).sum(axis=1)
+    return np.append(0, flux)
+
+
+def _estimate_tempo(onsets, frame_rate, min_tempo=60, max_tempo=200, prior_tempo=120.0):
+    """
+    Picks the tempo with the strongest autocorrelation of `onsets`, weighted
+    so that tempos far from `prior_tempo` are less likely.
+    """
+    if not onsets.std(): return prior_tempo
+    onsets = onsets - onsets.mean()
+    size = 2 ** int(np.ceil(np.log2(2 * len(onsets) + 1)))
+    spectrum = np.fft.rfft(onsets, size)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum))[:len(onsets)]
+    lags = np.arange(max(int(frame_rate * 60 / max_tempo), 1), int(frame_rate * 60 / min_tempo) + 1)
+    lags = lags[lags < len(autocorrelation) - 1]
+    if not len(lags): return prior_tempo
+    weights = np.exp(-0.5 * np.log2(frame_rate * 60 / lags / prior_tempo) ** 2)
+    best = lags[np.argmax(autocorrelation[lags] * weights)]
+
+    # Parabolic interpolation around the best lag, for a tempo that isn't quantized
+    before, at, after = autocorrelation[best - 1:best + 2]
+    curvature = before - 2 * at + after
+    offset = 0.5 * (before - after) / curvature if curvature < 0 else 0
+    return frame_rate * 60 / (best + offset)
+
+
+def _track_beats(onsets, period, tightness=100):
+    """
+    Dynamic programming beat tracker : finds the frames with strong onsets
+    which are spaced by about `period` frames.
+    """
+    if not len(onsets): return np.array([], dtype=int)
+    onsets = onsets / (onsets.std() or 1)
+    lags = np.arange(max(int(round(period / 2)), 1), int(round(2 * period)) + 1)
+    penalties = tightness * np.log(lags / period) ** 2
+    scores = onsets.copy()
+    backlinks = -np.ones(len(onsets), dtype=int)
+    for frame in xrange(lags[0], len(onsets)):
+        valid = lags[lags <= frame]
+        candidates = scores[frame - valid] - penalties[:len(valid)]
+        best = np.argmax(candidates)
+        if candidates[best] > 0:
+            scores[frame] += candidates[best]
+            backlinks[frame] = frame - valid[best]
+
+    # Backtracking from the best score in the last period
+    last_period = max(len(onsets) - int(period), 0)
+    beats = [last_period + int(np.argmax(scores[last_period:]))]
+    while backlinks[beats[-1]] >= 0: beats.append(backlinks[beats[-1]])
+    return np.array(beats[::-1], dtype=int)
+
+
+def _pick_peaks(onsets, frame_rate, min_gap=0.1, threshold=1.0):
+    """
+    Returns the frames where `onsets` has a local maximum higher than its mean plus
+    `threshold` standard deviations, at least `min_gap` seconds apart.
+    """
+    if len(onsets) < 3: return np.array([], dtype=int)
+    is_peak = (onsets[1:-1] > onsets[:-2]) & (onsets[1:-1] >= onsets[2:])
+    is_peak &= onsets[1:-1] > onsets.mean() + threshold * onsets.std()
+    candidates = np.flatnonzero(is_peak) + 1
+
+    # Strongest peaks first, each one hiding the weaker peaks which are too close
+    peaks, gap = [], max(int(min_gap * frame_rate), 1)
+    hidden = np.zeros(len(onsets), dtype=bool)
+    for frame in candidates[np.argsort(-onsets[candidates], kind='mergesort')]:
+        if hidden[frame]: continue
+        peaks.append(frame)
+        hidden[max(frame - gap + 1, 0):frame + gap] = True
+    return np.sort(np.array(peaks, dtype=int))
+
+
+def _confidences(onsets, frames):
+    """
+    Onset strengths at `frames`, normalized between 0 and 1.
+    """
+    if not len(frames): return []
+    return (onsets[frames] / (onsets.max() or 1)).tolist()
+
+
+def _frame_times(frames, sample_rate):
+    # Times of the centers of the frames
+    return (np.asarray(frames, dtype=float) * HOP_SIZE + FFT_SIZE / 2) / sample_rate
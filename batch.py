@@ -0,0 +1,116 @@
+"""
+Offline extraction of loops from many tracks at once, to fill the loop library
+before a show. Run with `python batch.py <track files>`.
+"""
+import os
+import time
+import argparse
+
+import numpy as np
+
+from sound import Track, SegmentIndex, score_bars
+from cache import AnalysisCache
+from pool import LoopRecord
+from library import LoopLibrary
+
+
+def extract_batch(tracks, library, loops_per_track=None, max_quality=60, cache=None):
+    """
+    Extracts loops from all `tracks`, a list of `(track_id, filename, analysis)`, and adds
+    them to the `LoopLibrary` `library`. Tracks whose analysis is `None` are analysed,
+    using `cache` if given.
+    The bars of all the tracks are filtered in a single pass, keeping those with a loop quality
+    under `max_quality`, and at most the `loops_per_track` best ones for each track.
+    Returns the list of the loops infos, and a dict with the time spent (in s.) in each stage.
+    """
+    timings = dict.fromkeys(['decode', 'analysis', 'score', 'write'], 0)
+    opened, decoded = [], []
+    try:
+        # Decoding and analysing the tracks
+        for track_id, filename, analysis in tracks:
+            before = time.time()
+            track = Track(filename)
+            opened.append(track)
+            timings['decode'] += time.time() - before
+            before = time.time()
+            if analysis is None:
+                sound = track.window(0, track.length)
+                if cache is not None: analysis = sound.cached_analysis(cache, track_id, 0, track.length)
+                else: analysis = sound.analyse()
+            decoded.append((track_id, track, analysis))
+            timings['analysis'] += time.time() - before
+        if not decoded: return [], timings
+
+        # Scoring the bars of all the tracks, and selecting the best ones
+        before = time.time()
+        features = np.concatenate([score_bars(analysis.bars, SegmentIndex(analysis.segments))
+            for track_id, track, analysis in decoded])
+        track_positions = np.repeat(np.arange(len(decoded)),
+            [len(analysis.bars) for track_id, track, analysis in decoded])
+        selected = np.flatnonzero(features['loop_quality'] < max_quality)
+        selected = selected[np.lexsort((features['loop_quality'][selected], track_positions[selected]))]
+        if loops_per_track is not None and len(selected):
+            # Rank of each loop among the loops of its track, the best first
+            positions = track_positions[selected]
+            group_starts = np.flatnonzero(np.append(True, positions[1:] != positions[:-1]))
+            ranks = np.arange(len(selected)) - np.repeat(group_starts, np.diff(np.append(group_starts, len(selected))))
+            selected = selected[ranks < loops_per_track]
+        selected = selected[np.lexsort((features['start'][selected], track_positions[selected]))]
+        timings['score'] += time.time() - before
+
+        # Writing the loops straight from the decoded tracks, and adding them to the library
+        before = time.time()
+        loops_infos = []
+        if not os.path.exists(library.directory): os.makedirs(library.directory)
+        for bar_features, position in zip(features[selected], track_positions[selected]):
+            track_id, track, analysis = decoded[position]
+            loop_id = '%s_%s' % (track_id, int(round(bar_features['start'] * 1000)))
+            path = library.temp_path('loop')
+            length = track.write(bar_features['start'], bar_features['start'] + bar_features['duration'], path)
+            loop_infos = {
+                'start': float(bar_features['start']),
+                'duration': float(bar_features['duration']),
+                'tempo': analysis.tempo,
+                'loop_quality': float(bar_features['loop_quality']),
+                'timbre_start': bar_features['timbre_start'].tolist(),
+                'timbre_end': bar_features['timbre_end'].tolist(),
+                'path': path,
+                'length': length,
+                'loop_id': loop_id,
+                'track_id': track_id
+            }
+            record = LoopRecord.from_infos(loop_infos)
+            library.add_loop(record)
+            loop_infos['path'] = record.path
+            loops_infos.append(loop_infos)
+        timings['write'] += time.time() - before
+    finally:
+        for track in opened: track.close()
+    return loops_infos, timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extracts loops from many tracks at once.')
+    parser.add_argument('filenames', nargs='+', help='track files, named after their track id')
+    parser.add_argument('--directory', default=None, help='directory of the library (defaults to the settings)')
+    parser.add_argument('--loops-per-track', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=8, help='number of tracks decoded at once')
+    args = parser.parse_args()
+
+    def track_id(filename):
+        # Track ids of SoundCloud tracks are integers
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return int(name) if name.isdigit() else name
+
+    cache = AnalysisCache()
+    library = LoopLibrary(args.directory)
+    loop_count, total_timings = 0, {}
+    for i in range(0, len(args.filenames), args.batch_size):
+        tracks = [(track_id(filename), filename, None) for filename in args.filenames[i:i + args.batch_size]]
+        loops_infos, timings = extract_batch(tracks, library, args.loops_per_track, cache=cache)
+        loop_count += len(loops_infos)
+        for stage, seconds in timings.items():
+            total_timings[stage] = total_timings.get(stage, 0) + seconds
+        print('%s/%s tracks, %s loops' % (min(i + args.batch_size, len(args.filenames)), len(args.filenames), loop_count))
+    print(', '.join('%s %.2fs' % (stage, total_timings[stage])
+        for stage in ['decode', 'analysis', 'score', 'write']))
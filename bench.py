@@ -0,0 +1,317 @@
+"""
+Benchmarks for versificator. Run with `python bench.py`, and with `--json <path>`
+to also save the results in a machine-readable form, to compare between versions.
+They use synthetic audio and synthetic analyses only, so no network, no Pd
+and no Echo Nest key are needed. Decoding tracks requires the decoder (ffmpeg).
+"""
+import os
+import sys
+import json
+import time
+import wave
+import random
+import shutil
+import tempfile
+import argparse
+
+import numpy as np
+
+from sound import Sound, SegmentIndex, score_bars, TIMBRE_SIZE
+from analysis import Analysis
+from stretch import stretch, stretch_batch, tempo_length
+from tools import euclidian_distance
+from pool import LoopRecord, ShardedPool
+from index import LoopIndex
+from library import LoopLibrary
+import workers
+import run
+
+results = []    # Results of all the benchmarks run, as dicts
+
+
+def report(name, seconds, **params):
+    """
+    Records the time `seconds` of the benchmark `name` run with `params`.
+    """
+    results.append(dict(params, name=name, seconds=seconds))
+
+
+class SyntheticAnalysis(Analysis):
+    """
+    Echo Nest-like analysis with `bar_count` bars of 4 beats at `tempo`.
+    Segments have random durations and random timbres, and they cover the whole analysis.
+    """
+
+    def __init__(self, bar_count, tempo=120.0, seed=0, timbre_spread=50):
+        rand = random.Random(seed)
+        beat_length = 60.0 / tempo
+        beats = [{'start': i * beat_length, 'duration': beat_length, 'confidence': 1.0}
+            for i in range(bar_count * 4)]
+        bars = [{'start': i * 4 * beat_length, 'duration': 4 * beat_length, 'confidence': 1.0}
+            for i in range(bar_count)]
+        segments = []
+        position, duration = 0, bar_count * 4 * beat_length
+        while position < duration:
+            seg_length = rand.choice([beat_length, 2 * beat_length, rand.uniform(0.05, 4 * beat_length)])
+            segments.append({
+                'start': position,
+                'duration': seg_length,
+                'timbre': [rand.gauss(0, timbre_spread) for i in range(TIMBRE_SIZE)]
+            })
+            position += seg_length
+        super(SyntheticAnalysis, self).__init__(bars, beats, segments, tempo)
+
+
+def reference_loop_quality(analysis):
+    """
+    Loop quality calculated bar by bar, as `Sound.echonest` used to do it.
+    """
+    segments = sorted(analysis.segments, key=lambda seg: seg['start'])
+    qualities = []
+    for bar in analysis.bars:
+        bar_start = bar['start']
+        bar_end = bar_start + bar['duration']
+        overlapping = []
+        for seg in segments:
+            seg_start = seg['start']
+            seg_end = seg['start'] + seg['duration']
+            if seg_start > bar_end: break
+            if ((bar_start > seg_start and bar_start < seg_end)
+              or (bar_end > seg_start and bar_end < seg_end)):
+                overlapping.append(seg)
+        if len(overlapping) == 1: qualities.append(0)
+        elif len(overlapping) == 2:
+            qualities.append(euclidian_distance(
+                np.array(overlapping[0]['timbre']),
+                np.array(overlapping[1]['timbre'])
+            ))
+        else: qualities.append(100000)
+    return np.array(qualities, dtype=float)
+
+
+def batched_loop_quality(analysis):
+    return score_bars(analysis.bars, SegmentIndex(analysis.segments))['loop_quality']
+
+
+def best_time(func, *args, **kwargs):
+    """
+    Returns the best time in seconds out of `repeat` calls of `func`.
+    """
+    repeat = kwargs.pop('repeat', 5)
+    times = []
+    for i in range(repeat):
+        before = time.time()
+        func(*args)
+        times.append(time.time() - before)
+    return min(times)
+
+
+def bench_loop_quality(bar_counts=(500, 1000, 2000)):
+    for bar_count in bar_counts:
+        analysis = SyntheticAnalysis(bar_count)
+        expected = reference_loop_quality(analysis)
+        got = batched_loop_quality(analysis)
+        # Only the summation order differs, so values can differ by float rounding.
+        assert np.allclose(expected, got, rtol=1e-12, atol=0), 'loop qualities differ'
+        reference_time = best_time(reference_loop_quality, analysis)
+        batched_time = best_time(batched_loop_quality, analysis)
+        report('loop_quality_reference', reference_time, bar_count=bar_count)
+        report('loop_quality', batched_time, bar_count=bar_count)
+        print('loop_quality %s bars, %s segments : per bar %.4fs, batched %.4fs (x%.1f)' % (
+            bar_count, len(analysis.segments), reference_time, batched_time,
+            reference_time / max(batched_time, 1e-9)))
+
+
+def synthetic_loop(tempo, sample_rate=44100, seed=0):
+    """
+    Stereo loop of one bar at `tempo` : a chord, with a noise burst on each beat.
+    """
+    rand = np.random.RandomState(seed)
+    beat_length = 60.0 / tempo
+    times = np.arange(int(4 * beat_length * sample_rate)) / float(sample_rate)
+    chord = sum(np.sin(2 * np.pi * freq * times) for freq in (220, 277.2, 329.6)) / 3
+    bursts = rand.randn(len(times)) * np.exp(-(times % beat_length) * 40)
+    mono = 0.5 * chord + 0.3 * bursts
+    return np.column_stack([mono, np.roll(mono, 100)])
+
+
+def spectral_similarity(frames1, frames2):
+    """
+    Cosine similarity of the average log-magnitude spectra of 2 sounds, 1 for identical spectra.
+    """
+    def spectrum(frames):
+        frames = np.asarray(frames, dtype=float).mean(axis=1)
+        blocks = frames[:len(frames) // 2048 * 2048].reshape(-1, 2048) * np.hanning(2048)
+        return np.log1p(np.abs(np.fft.rfft(blocks, axis=1)).mean(axis=0))
+    spectrum1, spectrum2 = spectrum(frames1), spectrum(frames2)
+    return np.dot(spectrum1, spectrum2) / (np.linalg.norm(spectrum1) * np.linalg.norm(spectrum2))
+
+
+def bench_stretch(tempos=(90, 120, 150), ratios=(1.005, 0.9, 1.25), sample_rate=44100):
+    for tempo in tempos:
+        frames = synthetic_loop(tempo, sample_rate=sample_rate)
+        length = len(frames) / float(sample_rate)
+        for ratio in ratios:
+            stretched = stretch(frames, sample_rate, length * ratio)
+            assert len(stretched) == int(round(length * ratio * sample_rate)), 'wrong length'
+            engine_time = best_time(stretch, frames, sample_rate, length * ratio, repeat=3)
+            current = Sound(frames, sample_rate=sample_rate).time_stretch(length * ratio)
+            current_time = best_time(Sound(frames, sample_rate=sample_rate).time_stretch, length * ratio, repeat=3)
+            report('stretch', engine_time, tempo=tempo, ratio=ratio)
+            report('stretch_reference', current_time, tempo=tempo, ratio=ratio)
+            print('stretch %.2fs loop x%s : engine %.4fs, current %.4fs, similarity to current %.3f, to original %.3f' % (
+                length, ratio, engine_time, current_time,
+                spectral_similarity(stretched, current.values), spectral_similarity(stretched, frames)))
+
+    # Loops from the same track have the same tempo and length
+    loops = [(synthetic_loop(tempo, seed=i), tempo) for i, tempo in enumerate([90, 100, 140, 150] * 5)]
+    batch_time = best_time(stretch_batch, loops, sample_rate, 120, repeat=3)
+    def one_by_one():
+        for frames, loop_tempo in loops:
+            stretch(frames, sample_rate, tempo_length(len(frames) / float(sample_rate), loop_tempo, 120))
+    one_by_one_time = best_time(one_by_one, repeat=3)
+    report('stretch_batch', batch_time, loop_count=len(loops))
+    report('stretch_one_by_one', one_by_one_time, loop_count=len(loops))
+    print('stretch batch of %s loops to 120 bpm : %.4fs, one by one %.4fs' % (
+        len(loops), batch_time, one_by_one_time))
+
+
+def synthetic_track(length, tempo=120.0, sample_rate=44100, seed=0):
+    """
+    Stereo track of `length` seconds, made of synthetic loops at `tempo`.
+    """
+    loop = synthetic_loop(tempo, sample_rate=sample_rate, seed=seed)
+    frame_count = int(length * sample_rate)
+    return np.tile(loop, (frame_count // len(loop) + 1, 1))[:frame_count]
+
+
+def synthetic_sound(length, tempo=120.0, sample_rate=44100, seed=0, timbre_spread=50):
+    """
+    `Sound` of `length` seconds, with a synthetic analysis covering all of it.
+    """
+    sound = Sound(synthetic_track(length, tempo, sample_rate, seed), sample_rate=sample_rate)
+    sound._echonest = SyntheticAnalysis(int(length * tempo / 240), tempo, seed, timbre_spread)
+    return sound
+
+
+class SyntheticAnalysisCache(object):
+    """
+    Analysis cache which always hits, with a synthetic analysis of the requested window.
+    """
+
+    def __init__(self, tempo=120.0, timbre_spread=5):
+        self.tempo = tempo
+        self.timbre_spread = timbre_spread
+
+    def get(self, track_id, offset, duration):
+        return SyntheticAnalysis(int(duration * self.tempo / 240), self.tempo,
+            seed=int(offset * 1000), timbre_spread=self.timbre_spread)
+
+    def put(self, analysis, track_id, offset, duration):
+        pass
+
+
+def write_wav(frames, path, sample_rate=44100):
+    wav_file = wave.open(path, 'wb')
+    try:
+        wav_file.setnchannels(frames.shape[1])
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes((np.clip(frames, -1, 1) * 32767).astype('<i2').tostring())
+    finally:
+        wav_file.close()
+
+
+def bench_sound(lengths=(20, 60, 180)):
+    for length in lengths:
+        sound = synthetic_sound(length)
+        def enrich():
+            sound._enriched_analysis = None
+            sound.echonest
+        enrich_time = best_time(enrich)
+        extract_time = best_time(sound.extract_loops)
+        remove_beats_time = best_time(sound.remove_beats, 0.01, repeat=3)
+        report('enrichment', enrich_time, track_length=length)
+        report('extract_loops', extract_time, track_length=length)
+        report('remove_beats', remove_beats_time, track_length=length)
+        print('sound %ss : enrichment %.4fs, extract_loops %.4fs, remove_beats %.4fs' % (
+            length, enrich_time, extract_time, remove_beats_time))
+
+
+def bench_scrape(lengths=(60, 180, 300)):
+    """
+    Times `LoopScraper.scrape` on synthetic tracks, with the analyses taken from
+    a synthetic cache, and loops saved in a temporary library. The scraping jobs
+    are run in the current process.
+    """
+    directory = tempfile.mkdtemp()
+    old_get_sound, old_release_sound, old_library = run.get_sound, run.release_sound, run.library
+    run.library = LoopLibrary(os.path.join(directory, 'library'))
+    run.library.purge()
+    old_analysis_cache = workers.analysis_cache
+    old_pool, old_index = run.LoopScraper.pool, run.LoopScraper.index
+    workers.analysis_cache = SyntheticAnalysisCache()
+    run.release_sound = lambda filename: None
+    try:
+        for length in lengths:
+            filename = os.path.join(directory, 'track%s.wav' % length)
+            write_wav(synthetic_track(length), filename)
+            run.get_sound = lambda: (length, filename, float(length))
+            scraper = run.LoopScraper()
+            paths = iter(os.path.join(directory, 'loop%s.wav' % i) for i in xrange(sys.maxint))
+            scraper._get_free_path = lambda: next(paths)
+            def scrape():
+                run.LoopScraper.pool, run.LoopScraper.index = ShardedPool(), LoopIndex()
+                random.seed(0)
+                scraper.scrape()
+            scrape_time = best_time(scrape, repeat=3)
+            report('scrape', scrape_time, track_length=length, loop_count=len(run.LoopScraper.pool))
+            print('scrape %ss track : %.4fs, %s loops' % (length, scrape_time, len(run.LoopScraper.pool)))
+    finally:
+        run.get_sound, run.release_sound, run.library = old_get_sound, old_release_sound, old_library
+        workers.analysis_cache = old_analysis_cache
+        run.LoopScraper.pool, run.LoopScraper.index = old_pool, old_index
+        shutil.rmtree(directory)
+
+
+def bench_selection(pool_sizes=(60, 600, 6000), loopers=4, seed=0):
+    """
+    Times the selection of the next loop by `gimme_loop_handler`, for pools of different sizes.
+    """
+    rand = np.random.RandomState(seed)
+    old_pool, old_index, old_loopers = run.LoopScraper.pool, run.LoopScraper.index, run.LoopScraper.pd_loopers
+    try:
+        for pool_size in pool_sizes:
+            run.LoopScraper.pool, run.LoopScraper.index = ShardedPool(), LoopIndex()
+            run.LoopScraper.pd_loopers = {}
+            for i in range(pool_size):
+                record = LoopRecord('%s_%s' % (i // 10, i), i // 10, 'loop%s.wav' % i, 2.0,
+                    rand.uniform(60, 180), 0, rand.normal(0, 50, TIMBRE_SIZE), rand.normal(0, 50, TIMBRE_SIZE))
+                run.LoopScraper.pool[record.loop_id] = record
+                run.LoopScraper.index.add(record)
+            for looper_id in range(loopers):
+                run.LoopScraper.register_looper(looper_id)
+                run.LoopScraper.reserve_track(looper_id, looper_id)
+            def select():
+                for looper_id in range(loopers):
+                    run.LoopScraper.select_loops(looper_id, 120, 3)
+            select_time = best_time(select) / loopers
+            report('selection', select_time, pool_size=pool_size)
+            print('selection in a pool of %s loops : %.6fs' % (pool_size, select_time))
+    finally:
+        run.LoopScraper.pool, run.LoopScraper.index = old_pool, old_index
+        run.LoopScraper.pd_loopers = old_loopers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the benchmarks of versificator.')
+    parser.add_argument('--json', help='path of the file where to save the results')
+    args = parser.parse_args()
+    bench_loop_quality()
+    bench_sound()
+    bench_scrape()
+    bench_selection()
+    bench_stretch()
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump({'time': time.time(), 'results': results}, fd, indent=2)
@@ -0,0 +1,161 @@
+import os
+import time
+import json
+import zlib
+import sqlite3
+import hashlib
+import collections
+import threading
+import logging
+logger = logging.getLogger('versificator')
+
+import settings
+from analysis import Analysis
+
+
+class AnalysisCache(object):
+    """
+    Persistent cache of analyses, stored in a SQLite database. Analyses are keyed by
+    analysis backend, and by track id, offset and duration of the analysed sample. When the total size
+    of the stored analyses exceeds `max_bytes`, the least recently used are evicted.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        if path is None: path = settings.app_root + 'cache/analyses.sqlite'
+        if max_bytes is None: max_bytes = getattr(settings, 'analysis_cache_bytes', 200 * 1024 * 1024)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+
+    def get(self, track_id, offset, duration):
+        """
+        Returns the cached `Analysis`, or `None` if there isn't one.
+        """
+        connection = self._connection()
+        key = self._key(track_id, offset, duration)
+        row = connection.execute('SELECT data FROM analyses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        with connection:
+            connection.execute('UPDATE analyses SET accessed = ? WHERE key = ?', (time.time(), key))
+        self.hits += 1
+        return Analysis.from_dict(json.loads(zlib.decompress(bytes(row[0]))))
+
+    def put(self, analysis, track_id, offset, duration):
+        """
+        Stores `analysis`, and evicts old analyses if the cache is full.
+        """
+        connection = self._connection()
+        data = zlib.compress(json.dumps(analysis.to_dict()))
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?)',
+                (self._key(track_id, offset, duration), sqlite3.Binary(data), len(data), time.time()))
+            self._evict(connection)
+
+    def _evict(self, connection):
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM analyses').fetchone()[0]
+        if total <= self.max_bytes: return
+        evicted = []
+        for key, size in connection.execute('SELECT key, size FROM analyses ORDER BY accessed'):
+            if total <= self.max_bytes: break
+            evicted.append((key,))
+            total -= size
+        connection.executemany('DELETE FROM analyses WHERE key = ?', evicted)
+        logger.debug('evicted %s analyses from the cache' % len(evicted))
+
+    def _key(self, track_id, offset, duration):
+        # Backends give different timbres, so their analyses must not be mixed
+        backend = getattr(settings, 'analysis_backend', 'echonest')
+        return '%s/%s/%.3f/%.3f' % (backend, track_id, offset, duration)
+
+    def _connection(self):
+        return local_connection(self._local, self.path, [
+            'CREATE TABLE IF NOT EXISTS analyses (key TEXT PRIMARY KEY, data BLOB, size INTEGER, accessed REAL)',
+            'CREATE INDEX IF NOT EXISTS analyses_accessed ON analyses (accessed)'
+        ])
+
+
+def local_connection(local, path, schema):
+    """
+    Returns the connection of the current thread to the SQLite database at `path`,
+    kept in the `threading.local` object `local`. SQLite connections cannot be shared
+    between threads or processes, so each of them opens its own, and runs the
+    statements in `schema` to create the tables if needed.
+    """
+    if getattr(local, 'pid', None) != os.getpid():
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory): os.makedirs(directory)
+        local.connection = sqlite3.connect(path, timeout=30)
+        local.pid = os.getpid()
+        with local.connection:
+            for statement in schema: local.connection.execute(statement)
+    return local.connection
+
+
+class RenderCache(object):
+    """
+    Cache of the rendered (stretched and faded) versions of the loops. Each rendering
+    is saved to a file named after the hash of its key, and the least recently used
+    renderings are deleted when they take more than `max_bytes` on disk.
+    The original loops are never modified.
+    """
+
+    in_place = False    # Renderings are written to new files
+
+    def __init__(self, directory=None, max_bytes=None):
+        if directory is None: directory = settings.app_root + 'renders/'
+        if max_bytes is None: max_bytes = getattr(settings, 'render_cache_bytes', 500 * 1024 * 1024)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = collections.OrderedDict()   # {key: (path, length, size)}, oldest first
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """
+        Deletes all the renderings, including the ones left by a previous run.
+        """
+        with self._lock:
+            if not os.path.exists(self.directory): os.makedirs(self.directory)
+            for filename in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, filename))
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def path_for(self, key):
+        """
+        Returns the path where the rendering `key` must be saved.
+        """
+        return os.path.join(self.directory, '%s.wav' % hashlib.sha1(repr(key)).hexdigest())
+
+    def get(self, key):
+        """
+        Returns `(path, length)` of the rendering `key`, or `None` if it isn't in the cache.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None: return None
+            self._entries[key] = entry
+            return entry[:2]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def add(self, key, length):
+        """
+        Adds the rendering `key`, which must have been saved to `path_for(key)`.
+        """
+        path = self.path_for(key)
+        size = os.path.getsize(path)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None: self.total_bytes -= previous[2]
+            self._entries[key] = (path, length, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, (old_path, old_length, old_size) = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+                if os.path.exists(old_path): os.remove(old_path)
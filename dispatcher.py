@@ -0,0 +1,45 @@
+import time
+import threading
+import traceback
+from Queue import Queue
+import logging
+logger = logging.getLogger('versificator')
+
+from metrics import metrics
+
+
+class Dispatcher(object):
+    """
+    Runs OSC handlers outside of the OSC server thread. The server thread
+    only queues the messages, and each address has its own queue and its own
+    workers, so a slow handler never delays messages sent to other addresses.
+    The number of workers of an address limits how many of its messages are
+    handled concurrently. For each address, the time messages wait in the queue,
+    the time it takes to handle them, and the total are recorded in `metrics`.
+    """
+
+    def add_handler(self, server, address, handler, concurrency=1):
+        queue = Queue()
+        for i in range(concurrency):
+            worker = threading.Thread(target=self._work, args=(address, handler, queue))
+            worker.daemon = True
+            worker.start()
+        def enqueue(*args):
+            queue.put((time.time(), args))
+        server.addMsgHandler(address, enqueue)
+
+    def _work(self, address, handler, queue):
+        name = address.strip('/').replace('/', '_')
+        while True:
+            received, args = queue.get()
+            started = time.time()
+            try:
+                handler(*args)
+            except:
+                print traceback.format_exc()
+            finished = time.time()
+            metrics.observe('%s_wait_seconds' % name, started - received)
+            metrics.observe('%s_handling_seconds' % name, finished - started)
+            metrics.observe('%s_seconds' % name, finished - received)
+            logger.debug('%s handled in %.3fs, waited %.3fs' % (address, finished - started, started - received))
+
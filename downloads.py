@@ -0,0 +1,183 @@
+import os
+import time
+import random
+import threading
+import traceback
+import email.utils
+from Queue import Queue, Empty
+import requests
+import logging
+logger = logging.getLogger('versificator')
+
+import settings
+from metrics import metrics
+
+
+class Downloader(object):
+    """
+    Downloads random tracks from SoundCloud ahead of the scrapers, so that they only
+    wait on a local queue of tracks that are already on disk. At most `queue_size`
+    tracks are waiting in the queue, and they are downloaded by `workers` threads
+    sharing a pool of HTTP connections. When the downloads take more than `max_bytes`
+    on disk, the oldest files that are neither queued nor in use are deleted.
+    Requests time out after `timeout`, `(connect, read)` in seconds, and when the API
+    refuses them, all the workers wait longer and longer before trying again.
+    """
+
+    def __init__(self, api_root='https://api.soundcloud.com', client_id=None, directory=None,
+            queue_size=None, workers=None, max_bytes=None, timeout=None):
+        self.api_root = api_root
+        self.client_id = client_id or getattr(settings, 'soundcloud_client_id', 'YOUR_CLIENT_ID')
+        # Not `app_root/downloads/`, which has the debug sounds that must not be deleted
+        self.directory = directory or getattr(settings, 'downloads_directory', settings.app_root + 'soundcloud/')
+        self.workers = workers or getattr(settings, 'download_threads', 2)
+        self.max_bytes = max_bytes or getattr(settings, 'downloads_max_bytes', 1024 * 1024 * 1024)
+        self.tracks = Queue(queue_size or getattr(settings, 'download_queue_size', 4))
+        self.timeout = timeout or getattr(settings, 'download_timeout', (5, 30))
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._queued = set()            # Files in the queue
+        self._in_use = set()            # Files handed to the scrapers, and not released yet
+        self._lock = threading.Lock()
+        self._started = False
+        self._backoff = 0               # Last delay (in s.) waited because the API refused a request
+        self._refused_until = 0         # Time until which no request is sent
+
+    def start(self):
+        with self._lock:
+            if self._started: return
+            self._started = True
+        if not os.path.exists(self.directory): os.makedirs(self.directory)
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def get(self):
+        """
+        Returns `(track_id, filename, length)` of a downloaded track, length in seconds.
+        The track must be released with `release` when it is not needed anymore.
+        """
+        self.start()
+        while True:
+            # Waiting with a timeout, otherwise the wait cannot be interrupted
+            try: track_id, filename, length = self.tracks.get(True, 60)
+            except Empty: continue
+            with self._lock:
+                self._queued.discard(filename)
+                self._in_use.add(filename)
+            return track_id, filename, length
+
+    def release(self, filename):
+        with self._lock: self._in_use.discard(filename)
+
+    def fetch_random_track(self):
+        """
+        Downloads a random track, and returns `(track_id, filename, length)`,
+        or `None` if the track cannot be used.
+        """
+        # Get a random track. When the API refuses our requests (bad client id,
+        # or rate limiting) or cannot be reached, we give up and the workers back off.
+        retry_delay = 0.1
+        while (True):
+            track_id = random.randint(0, 100000)
+            try:
+                resp = self.session.get('%s/tracks/%s.json' % (self.api_root, track_id),
+                    params={'client_id': self.client_id}, timeout=self.timeout)
+            except requests.RequestException as exc:
+                logger.error('request failed : %s' % exc)
+                self._back_off()
+                return None
+            if resp.status_code == 200:
+                with self._lock: self._backoff = 0
+                break
+            elif resp.status_code in (401, 403, 429):
+                logger.error('%s - %s' % (resp, track_id))
+                self._back_off(resp.headers.get('Retry-After'))
+                return None
+            elif resp.status_code != 404:
+                logger.error('%s - %s' % (resp, track_id))
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 30)
+            else: logger.debug('%s - %s' % (resp, track_id))
+        track = resp.json()
+
+        # We don't want too long tracks because of memory pbs.
+        sound_length = track.get('duration', 0)
+        if sound_length > 60 * 5000: return None
+        if not track.get('stream_url'): return None
+
+        # Downloading track to a temporary file, so that no other thread sees it before it's complete
+        logger.info('downloading track %s' % track['stream_url'])
+        try:
+            resp = self.session.get(track['stream_url'], params={'client_id': self.client_id},
+                stream=True, timeout=self.timeout)
+        except requests.RequestException as exc:
+            logger.error('tried to download track, but failed : %s' % exc)
+            return None
+        if resp.status_code != 200:
+            logger.error('tried to download track, but got %s' % resp)
+            return None
+        filename = self.directory + '%s.mp3' % track_id
+        logger.info('saving track to %s' % filename)
+        try:
+            with open(filename + '.part', 'wb') as fd, metrics.timer('download_seconds'):
+                for chunk in resp.iter_content(64 * 1024):
+                    fd.write(chunk)
+            os.rename(filename + '.part', filename)
+        except Exception as exc:
+            logger.error('file download failed : %s' % exc)
+            if os.path.exists(filename + '.part'): os.remove(filename + '.part')
+            return None
+        return track_id, filename, sound_length / 1000.0
+
+    def _work(self):
+        while True:
+            try:
+                wait = self._refused_until - time.time()
+                if wait > 0: time.sleep(wait)
+                track = self.fetch_random_track()
+                if track is None: continue
+                with self._lock: self._queued.add(track[1])
+                self._make_room()
+                self.tracks.put(track)
+            except:
+                print traceback.format_exc()
+                time.sleep(1)
+
+    def _back_off(self, retry_after=None):
+        """
+        Delays the next requests of all the workers, twice longer each time, up to 5 minutes.
+        If the API told how long to wait with a `Retry-After` header, that is used instead.
+        """
+        with self._lock:
+            self._backoff = min(self._backoff * 2 or 1, 300)
+            delay = self._backoff
+            if retry_after:
+                # `Retry-After` is either a number of seconds, or a date
+                if retry_after.isdigit(): delay = int(retry_after)
+                else:
+                    date = email.utils.parsedate_tz(retry_after)
+                    if date is not None: delay = email.utils.mktime_tz(date) - time.time()
+            self._refused_until = max(self._refused_until, time.time() + delay)
+            logger.info('waiting %.1fs before the next requests' % delay)
+
+    def _make_room(self):
+        """
+        Deletes the oldest downloads which aren't used, until they take less than `max_bytes`.
+        """
+        with self._lock:
+            keep = self._queued | self._in_use
+            paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+            files = [(os.path.getmtime(path), os.path.getsize(path), path)
+                for path in paths if os.path.isfile(path) and not path.endswith('.part')]
+            total = sum(size for mtime, size, path in files)
+            for mtime, size, path in sorted(files):
+                if total <= self.max_bytes: break
+                if path in keep: continue
+                os.remove(path)
+                total -= size
+
+downloader = Downloader()
@@ -0,0 +1,123 @@
+import threading
+import collections
+
+import numpy as np
+
+from sound import TIMBRE_SIZE
+
+
+class LoopIndex(object):
+    """
+    Similarity index over the loops of a pool. It keeps the `timbre_end` and the tempo
+    of all loops in NumPy arrays, so that the best loops to follow a given loop
+    are found in a single vectorized pass. The index is updated incrementally
+    when loops are added to or removed from the pool.
+
+    Writers take a lock, but readers don't : they work on a snapshot of the arrays.
+    Rows of a snapshot are never moved, removed loops are only marked as dead,
+    and dead rows are dropped when the arrays are full, by copying the live rows
+    to new arrays.
+    """
+
+    def __init__(self, capacity=64):
+        self._lock = threading.Lock()
+        self._rows = {}                                 # {loop_id: row}
+        self._track_codes = {}                          # {track_id: code}
+        # Snapshot : timbres, tempos, track codes, alive flags, loop ids and number of rows used
+        self._state = (np.zeros((capacity, TIMBRE_SIZE), dtype=np.float32), np.zeros(capacity),
+            np.zeros(capacity, dtype=int), np.zeros(capacity, dtype=bool), [], 0)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, loop_id):
+        return loop_id in self._rows
+
+    def add(self, loop_infos):
+        with self._lock:
+            self._remove(loop_infos.loop_id)
+            if self._state[-1] == len(self._state[1]): self._compact()
+            timbres, tempos, tracks, alive, loop_ids, size = self._state
+            if loop_infos.timbre_end is not None: timbres[size] = loop_infos.timbre_end
+            else: timbres[size] = 0
+            tempos[size] = loop_infos.tempo
+            tracks[size] = self._track_codes.setdefault(loop_infos.track_id, len(self._track_codes))
+            alive[size] = True
+            loop_ids.append(loop_infos.loop_id)
+            self._rows[loop_infos.loop_id] = size
+            self._state = (timbres, tempos, tracks, alive, loop_ids, size + 1)
+
+    def add_many(self, loops_infos):
+        """
+        Adds all `loops_infos` at once, with at most one compaction. This is
+        much faster than calling `add` for each loop, e.g. to fill the index at startup.
+        """
+        # If a loop is given several times, the last infos are kept
+        loops_infos = collections.OrderedDict((loop_infos.loop_id, loop_infos)
+            for loop_infos in loops_infos).values()
+        if not loops_infos: return
+        with self._lock:
+            for loop_infos in loops_infos: self._remove(loop_infos.loop_id)
+            if self._state[-1] + len(loops_infos) > len(self._state[1]): self._compact(len(loops_infos))
+            timbres, tempos, tracks, alive, loop_ids, size = self._state
+            end = size + len(loops_infos)
+            timbres[size:end] = [loop_infos.timbre_end if loop_infos.timbre_end is not None
+                else np.zeros(TIMBRE_SIZE) for loop_infos in loops_infos]
+            tempos[size:end] = [loop_infos.tempo for loop_infos in loops_infos]
+            tracks[size:end] = [self._track_codes.setdefault(loop_infos.track_id, len(self._track_codes))
+                for loop_infos in loops_infos]
+            alive[size:end] = True
+            loop_ids.extend(loop_infos.loop_id for loop_infos in loops_infos)
+            self._rows.update((loop_infos.loop_id, row) for row, loop_infos in enumerate(loops_infos, size))
+            self._state = (timbres, tempos, tracks, alive, loop_ids, end)
+
+    def remove(self, loop_id):
+        with self._lock: self._remove(loop_id)
+
+    def best(self, timbre_start, required_tempo, count, forbidden_tracks=()):
+        """
+        Returns the ids of the `count` loops which follow best a loop starting with
+        `timbre_start`, at `required_tempo`, best first. Loops from `forbidden_tracks`
+        are left out. If `timbre_start` is None, only the tempo is taken into account.
+        """
+        timbres, tempos, tracks, alive, loop_ids, size = self._state
+        if not size or count <= 0: return []
+        scores = np.abs(1 - tempos[:size] / float(required_tempo)) * 40
+        if timbre_start is not None:
+            diff = timbres[:size] - np.asarray(timbre_start, dtype=float)
+            scores += np.sqrt((diff * diff).sum(axis=1))
+        scores[~alive[:size]] = np.inf
+
+        codes = [self._track_codes[t] for t in forbidden_tracks if t in self._track_codes]
+        if codes: scores[np.in1d(tracks[:size], codes)] = np.inf
+        count = min(count, int(np.isfinite(scores).sum()))
+        if not count: return []
+
+        rows = np.argpartition(scores, count - 1)[:count]
+        rows = rows[np.argsort(scores[rows], kind='mergesort')]
+        return [loop_ids[row] for row in rows]
+
+    def _remove(self, loop_id):
+        row = self._rows.pop(loop_id, None)
+        if row is not None: self._state[3][row] = False
+
+    def _compact(self, extra=0):
+        """
+        Copies the live rows to new arrays, twice bigger if more than half of the rows are alive,
+        counting `extra` rows about to be added, and bigger again until they are at most half full.
+        """
+        timbres, tempos, tracks, alive, loop_ids, size = self._state
+        live = np.flatnonzero(alive[:size])
+        capacity = len(tempos)
+        while len(live) + extra > capacity // 2: capacity *= 2
+        new_timbres = np.zeros((capacity, TIMBRE_SIZE), dtype=np.float32)
+        new_timbres[:len(live)] = timbres[live]
+        new_tempos = np.zeros(capacity)
+        new_tempos[:len(live)] = tempos[live]
+        new_tracks = np.zeros(capacity, dtype=int)
+        new_tracks[:len(live)] = tracks[live]
+        new_alive = np.zeros(capacity, dtype=bool)
+        new_alive[:len(live)] = True
+        new_loop_ids = [loop_ids[row] for row in live]
+        self._rows = dict((loop_id, row) for row, loop_id in enumerate(new_loop_ids))
+        self._state = (new_timbres, new_tempos, new_tracks, new_alive, new_loop_ids, len(live))
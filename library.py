@@ -0,0 +1,182 @@
+"""
+Persistent library of the loops and pads scraped, so that the pools are ready
+right after a restart. Sound files are named after the hash of their content,
+and their infos are indexed in a SQLite database.
+"""
+import os
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+import traceback
+import collections
+from Queue import Queue, Empty
+import logging
+logger = logging.getLogger('versificator')
+
+import numpy as np
+
+import settings
+from pool import LoopRecord
+from cache import local_connection
+
+
+class LoopLibrary(object):
+    """
+    Sound files saved in `directory`, indexed in the SQLite database at `path`.
+    Loops and pads are marked as consumed when they are sent to Pd. Once `start`
+    is called, a writer thread records that and deletes them `delete_delay` seconds
+    later, when Pd has loaded them. Consumed sounds left by a previous run are deleted by `purge`.
+    """
+
+    def __init__(self, directory=None, path=None, delete_delay=None):
+        if directory is None: directory = getattr(settings, 'library_directory', settings.app_root + 'sounds/')
+        if path is None: path = os.path.join(directory, 'library.sqlite')
+        if delete_delay is None: delete_delay = getattr(settings, 'library_delete_delay', 60)
+        self.directory = directory
+        self.path = path
+        self.delete_delay = delete_delay
+        self._local = threading.local()
+        self._consumed = Queue()        # Sounds sent to Pd, which the writer must record
+
+    def start(self):
+        writer = threading.Thread(target=self._write_consumed)
+        writer.daemon = True
+        writer.start()
+
+    def temp_path(self, prefix=''):
+        """
+        Returns a new path in the library where a sound can be saved before it is added.
+        """
+        return os.path.join(self.directory, '%s%s.part.wav' % (prefix, uuid.uuid4().hex))
+
+    def add_loop(self, record):
+        """
+        Moves the loop file of `record` to its final path, and adds it to the library.
+        """
+        record.path = self._store(record.path)
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO loops VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?)', (
+                record.loop_id, record.track_id, record.path, record.length, record.tempo,
+                record.loop_quality, self._timbre_blob(record.timbre_start),
+                self._timbre_blob(record.timbre_end), time.time()))
+
+    def add_pad(self, pad_infos):
+        """
+        Moves the pad file to its final path, and adds it to the library.
+        """
+        pad_infos['path'] = self._store(pad_infos['path'])
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO pads VALUES (?, ?, 0, ?)',
+                (pad_infos['pad_id'], pad_infos['path'], time.time()))
+
+    def consume_loop(self, loop_id, path):
+        """
+        Marks the loop as consumed. This doesn't wait for the database, so it can be
+        called when serving requests.
+        """
+        self._consumed.put(('loops', 'loop_id', loop_id, path))
+
+    def consume_pad(self, pad_id, path):
+        self._consumed.put(('pads', 'pad_id', pad_id, path))
+
+    def loops(self):
+        """
+        Returns the `LoopRecord` of all the loops which haven't been consumed, oldest first.
+        """
+        rows = self._connection().execute('SELECT loop_id, track_id, path, length, tempo, loop_quality,'
+            ' timbre_start, timbre_end FROM loops WHERE consumed = 0 ORDER BY added')
+        return [LoopRecord(loop_id, track_id, path, length, tempo, loop_quality,
+                self._timbre(timbre_start), self._timbre(timbre_end))
+            for loop_id, track_id, path, length, tempo, loop_quality, timbre_start, timbre_end in rows]
+
+    def pads(self):
+        """
+        Returns the infos of all the pads which haven't been consumed, oldest first.
+        """
+        rows = self._connection().execute('SELECT pad_id, path FROM pads WHERE consumed = 0 ORDER BY added')
+        return [{'pad_id': pad_id, 'path': path} for pad_id, path in rows]
+
+    def purge(self):
+        """
+        Deletes the consumed loops and pads, the files which were being saved,
+        and the entries whose file is missing. This must be called before sounds
+        are sent to Pd, because the consumed ones might still be in use.
+        """
+        connection = self._connection()
+        kept = set()
+        with connection:
+            for table, key in [('loops', 'loop_id'), ('pads', 'pad_id')]:
+                for entry_id, path, consumed in connection.execute(
+                        'SELECT %s, path, consumed FROM %s' % (key, table)).fetchall():
+                    if consumed or not os.path.exists(path):
+                        connection.execute('DELETE FROM %s WHERE %s = ?' % (table, key), (entry_id,))
+                    else: kept.add(os.path.basename(path))
+        removed = 0
+        if not os.path.exists(self.directory): os.makedirs(self.directory)
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.wav') and filename not in kept:
+                os.remove(os.path.join(self.directory, filename))
+                removed += 1
+        logger.info('library purged, %s files removed' % removed)
+
+    def _write_consumed(self):
+        """
+        Records the consumed sounds in batches, and deletes them after `delete_delay` seconds.
+        """
+        waiting = collections.deque()   # (time consumed, table, key, entry id, path), oldest first
+        while True:
+            consumed = []
+            try:
+                consumed.append(self._consumed.get(True, 1))
+                while True: consumed.append(self._consumed.get_nowait())
+            except Empty: pass
+            try:
+                connection = self._connection()
+                if consumed:
+                    with connection:
+                        for table, key, entry_id, path in consumed:
+                            connection.execute('UPDATE %s SET consumed = 1 WHERE %s = ?' % (table, key), (entry_id,))
+                    waiting.extend((time.time(),) + item for item in consumed)
+
+                expired = []
+                while waiting and waiting[0][0] < time.time() - self.delete_delay: expired.append(waiting.popleft())
+                if not expired: continue
+                with connection:
+                    for consumed_time, table, key, entry_id, path in expired:
+                        connection.execute('DELETE FROM %s WHERE %s = ? AND consumed = 1' % (table, key), (entry_id,))
+                        # The same sound might have been scraped again since, then its file is kept
+                        in_use = connection.execute('SELECT COUNT(*) FROM %s WHERE path = ?' % table, (path,)).fetchone()[0]
+                        if not in_use and os.path.exists(path): os.remove(path)
+            except:
+                print traceback.format_exc()
+
+    def _store(self, path):
+        """
+        Renames the file at `path` after the hash of its content, and returns the new path.
+        """
+        content_hash = hashlib.sha1()
+        with open(path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(64 * 1024), ''):
+                content_hash.update(chunk)
+        new_path = os.path.join(self.directory, '%s.wav' % content_hash.hexdigest())
+        os.rename(path, new_path)
+        return new_path
+
+    def _timbre_blob(self, timbre):
+        if timbre is None: return None
+        return sqlite3.Binary(np.asarray(timbre, dtype='<f4').tostring())
+
+    def _timbre(self, blob):
+        if blob is None: return None
+        return np.frombuffer(bytes(blob), dtype='<f4')
+
+    def _connection(self):
+        return local_connection(self._local, self.path, [
+            'CREATE TABLE IF NOT EXISTS loops (loop_id TEXT PRIMARY KEY, track_id, path TEXT, length REAL,'
+            ' tempo REAL, loop_quality REAL, timbre_start BLOB, timbre_end BLOB, consumed INTEGER, added REAL)',
+            'CREATE TABLE IF NOT EXISTS pads (pad_id TEXT PRIMARY KEY, path TEXT, consumed INTEGER, added REAL)'
+        ])
+
+library = LoopLibrary()
@@ -0,0 +1,144 @@
+"""
+Instrumentation of the scraping and serving pipeline. Latencies are recorded
+in histograms, and gauges sample values like the pool sizes when the metrics
+are dumped, in the Prometheus text format.
+"""
+import os
+import time
+import threading
+import contextlib
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, float('inf'))
+
+
+class Histogram(object):
+    """
+    Counts the observed values in the buckets whose upper bounds are `buckets`.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket containing the quantile `q`.
+        """
+        with self._lock:
+            rank = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets, self.counts):
+                seen += count
+                if seen >= rank and seen > 0: return min(bound, self.max)
+            return 0
+
+
+class Metrics(object):
+    """
+    Registry of the histograms and gauges. Observations made in the scraping processes
+    are recorded with `recording()`, sent back with the job results, and merged with `merge`.
+    """
+
+    def __init__(self, prefix='versificator_'):
+        self.prefix = prefix
+        self.histograms = {}    # {name: Histogram}
+        self.gauges = {}        # {name: function returning the value}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None: histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+        recorded = getattr(self._local, 'recorded', None)
+        if recorded is not None: recorded.append((name, value))
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Observes the time (in s.) spent in the block in the histogram `name`.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started)
+
+    @contextlib.contextmanager
+    def recording(self):
+        """
+        Yields the list of the `(name, value)` observed by the current thread in the block.
+        """
+        previous = getattr(self._local, 'recorded', None)
+        self._local.recorded = recorded = []
+        try:
+            yield recorded
+        finally:
+            self._local.recorded = previous
+            if previous is not None: previous.extend(recorded)
+
+    def merge(self, recorded):
+        for name, value in recorded: self.observe(name, value)
+
+    def gauge(self, name, func):
+        """
+        Registers the gauge `name`, whose value is `func()`.
+        """
+        self.gauges[name] = func
+
+    def summary(self):
+        """
+        Returns a list of `(name, values)`, with `(count, mean, p50, p95, max)` for histograms
+        and `(value,)` for gauges.
+        """
+        summary = []
+        for name, histogram in sorted(self.histograms.items()):
+            mean = histogram.sum / float(histogram.count) if histogram.count else 0
+            summary.append((name, (histogram.count, mean,
+                histogram.quantile(0.5), histogram.quantile(0.95), histogram.max)))
+        for name, func in sorted(self.gauges.items()):
+            summary.append((name, (float(func()),)))
+        return summary
+
+    def dump(self):
+        """
+        Returns all the metrics in the Prometheus text format.
+        """
+        lines = []
+        for name, histogram in sorted(self.histograms.items()):
+            name = self.prefix + name
+            lines.append('# TYPE %s histogram' % name)
+            with histogram._lock:
+                cumulated = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulated += count
+                    bound = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket{le="%s"} %s' % (name, bound, cumulated))
+                lines.append('%s_sum %r' % (name, float(histogram.sum)))
+                lines.append('%s_count %s' % (name, histogram.count))
+        for name, func in sorted(self.gauges.items()):
+            name = self.prefix + name
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %r' % (name, float(func())))
+        return '\n'.join(lines) + '\n'
+
+    def dump_to_file(self, path):
+        with open(path + '.tmp', 'w') as fd: fd.write(self.dump())
+        os.rename(path + '.tmp', path)
+
+metrics = Metrics()
@@ -0,0 +1,99 @@
+import threading
+
+import numpy as np
+
+
+class LoopRecord(object):
+    """
+    Infos of a loop kept in the pool. Only the fields needed to select the loop
+    and to send it to Pd are kept, and timbres are stored as float32 vectors,
+    so that large pools stay small in memory.
+    """
+
+    __slots__ = ('loop_id', 'track_id', 'path', 'length', 'tempo', 'loop_quality',
+        'timbre_start', 'timbre_end')
+
+    def __init__(self, loop_id, track_id, path, length, tempo, loop_quality,
+            timbre_start, timbre_end):
+        self.loop_id = loop_id
+        self.track_id = track_id
+        self.path = path
+        self.length = length
+        self.tempo = tempo
+        self.loop_quality = loop_quality
+        self.timbre_start = self._timbre(timbre_start)
+        self.timbre_end = self._timbre(timbre_end)
+
+    @classmethod
+    def from_infos(cls, loop_infos):
+        """
+        Creates a record from the dict of infos returned by the scraping jobs.
+        """
+        return cls(*[loop_infos[name] for name in cls.__slots__])
+
+    def _timbre(self, timbre):
+        if timbre is None: return None
+        return np.asarray(timbre, dtype=np.float32)
+
+
+class ShardedPool(object):
+    """
+    Dict-like pool which can be read without locking. Entries are spread over
+    `shard_count` shards, each with its own lock for writers. Shards are never
+    modified : writers replace them with a modified copy, so readers always
+    see a consistent snapshot of each shard.
+    """
+
+    def __init__(self, shard_count=8):
+        self._shards = [{} for i in range(shard_count)]
+        self._locks = [threading.Lock() for i in range(shard_count)]
+
+    def __setitem__(self, key, value):
+        position = self._position(key)
+        with self._locks[position]:
+            shard = dict(self._shards[position])
+            shard[key] = value
+            self._shards[position] = shard
+
+    def update(self, items):
+        """
+        Adds all the `(key, value)` of `items`, copying each shard only once.
+        """
+        added = [{} for shard in self._shards]
+        for key, value in items: added[self._position(key)][key] = value
+        for position, shard_added in enumerate(added):
+            if not shard_added: continue
+            with self._locks[position]:
+                shard = dict(self._shards[position])
+                shard.update(shard_added)
+                self._shards[position] = shard
+
+    def pop(self, key, *default):
+        """
+        Removes `key` and returns its value. If several threads pop the same key
+        at once, only one of them gets it, the others get `default`.
+        """
+        position = self._position(key)
+        with self._locks[position]:
+            if key not in self._shards[position]:
+                if default: return default[0]
+                raise KeyError(key)
+            shard = dict(self._shards[position])
+            value = shard.pop(key)
+            self._shards[position] = shard
+            return value
+
+    def get(self, key, default=None):
+        return self._shards[self._position(key)].get(key, default)
+
+    def __contains__(self, key):
+        return key in self._shards[self._position(key)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def values(self):
+        return [value for shard in self._shards for value in shard.values()]
+
+    def _position(self, key):
+        return hash(key) % len(self._shards)
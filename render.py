@@ -0,0 +1,98 @@
+import threading
+import traceback
+import logging
+logger = logging.getLogger('versificator')
+
+import settings
+from workers import render_engine, render_loop
+from cache import RenderCache
+from shm import ShmRing
+
+
+class PreRenderer(threading.Thread):
+    """
+    Speculatively renders loops in the background, so that they are ready
+    when a looper asks for them. `candidates` is called to get the list of
+    `(loop_infos, tempo)` that are likely to be requested next. Renderings
+    are kept in a `RenderCache`, so loopers at the same tempo share them,
+    or in a `ShmRing` if the setting `render_to_shm` is True.
+    """
+
+    def __init__(self, candidates, interval=1, fade=(0.002, 0.002)):
+        super(PreRenderer, self).__init__()
+        self.daemon = True
+        self.candidates = candidates
+        self.interval = interval        # Time (in s.) between two checks of the candidates
+        self.hits = 0                   # Number of loops that were ready when requested
+        self.misses = 0                 # Number of loops that had to be waited for
+        self.fade = fade                # Fade in and fade out durations (in s.)
+        if getattr(settings, 'render_to_shm', False): self.cache = ShmRing()
+        else: self.cache = RenderCache()
+        self._rendering = set()         # Keys of the loops being rendered
+        self._condition = threading.Condition()
+        self._wake_up = threading.Event()
+
+    def wake_up(self):
+        """
+        Tells the renderer that the candidates have changed.
+        """
+        self._wake_up.set()
+
+    def run(self):
+        self.cache.clear()
+        while True:
+            self._wake_up.wait(self.interval)
+            self._wake_up.clear()
+            try:
+                for loop_infos, tempo in self.candidates():
+                    if self._reserve(self._key(loop_infos, tempo)):
+                        self._render(loop_infos, tempo)
+            except:
+                print traceback.format_exc()
+
+    def get(self, loop_infos, tempo):
+        """
+        Returns `(path, length)` of the loop rendered for `tempo`. If it isn't ready,
+        this waits for the rendering in progress, or renders the loop right away.
+        """
+        key = self._key(loop_infos, tempo)
+        rendered = self.cache.get(key)
+        if rendered is not None:
+            self.hits += 1
+            return rendered
+        self.misses += 1
+
+        # Either the loop is being rendered and we wait for it, or we render it.
+        # If another rendering failed, we try again ourselves. The looper is waiting,
+        # so we render in this thread rather than queue behind other jobs.
+        while True:
+            if self._reserve(key): self._render(loop_infos, tempo, inline=True)
+            with self._condition:
+                while key in self._rendering: self._condition.wait()
+            rendered = self.cache.get(key)
+            if rendered is not None: return rendered
+
+    def _reserve(self, key):
+        """
+        Returns True if the loop `key` needs to be rendered, and marks it as being rendered.
+        """
+        with self._condition:
+            if key in self.cache or key in self._rendering: return False
+            self._rendering.add(key)
+            return True
+
+    def _render(self, loop_infos, tempo, inline=False):
+        key = self._key(loop_infos, tempo)
+        args = (loop_infos.path, self.cache.path_for(key), loop_infos.tempo, tempo,
+            self.fade[0], self.fade[1], self.cache.in_place)
+        try:
+            if inline: length = render_loop(*args)
+            else: length = render_engine.run(render_loop, *args)
+            self.cache.add(key, length)
+        finally:
+            with self._condition:
+                self._rendering.discard(key)
+                self._condition.notify_all()
+
+    def _key(self, loop_infos, tempo):
+        return (loop_infos.loop_id, int(round(tempo * 100))) + self.fade
@@ -24,7 +24,16 @@ config.ECHO_NEST_API_KEY = settings.echonest_api_key
 from sound import Sound
 from pychedelic.utils import convert_file
 
-from tools import get_sound, send_msg, loop_distance
+from tools import get_sound, release_sound, send_msg, OSCSender
+from index import LoopIndex
+from pool import LoopRecord, ShardedPool
+from workers import engine, render_engine, scrape_loops, scrape_pad
+from render import PreRenderer
+from dispatcher import Dispatcher
+from scheduler import scheduler
+from downloads import downloader
+from metrics import metrics
+from library import library
 
 
 class ScraperType(type):
@@ -35,57 +44,37 @@ class ScraperType(type):
         defaults = dict(
             pool = {},                      # Pool containing the loops
             pool_lock = threading.RLock(),  # Lock to access the pool
-            pool_min_size = 15,             # Pool will always contain at least that much loops
-            names_lock = threading.RLock(), # Lock to get a unique name for a sound file to save
-            name_counter = 0,               # Counter used to "uniquely" name the soudn files
+            pool_min_size = 15,             # Pool is refilled when it has less loops than that
+            pool_max_size = 20,             # ... until it has at least that much loops
+            max_scrapes = 1,                # Maximum number of scrapes running at once for the pool
             filename_prefix = ''
         )
         for key, value in defaults.items(): attrs.setdefault(key, value)
         return super(ScraperType, cls).__new__(cls, name, bases, attrs)
 
 
-class BaseScraper(threading.Thread):
+class BaseScraper(object):
 
     __metaclass__ = ScraperType
 
-    def __init__(self, *args, **kwargs):
-        super(BaseScraper, self).__init__(*args, **kwargs)
-        self.daemon = True
-
-    def run(self):
-        """
-        This fills up the loop pool until there is at least `pool_min_size` loops in it.
-        The method which actually fills-up the pool is `scrape`.
-        """
-        while (len(self.pool) < self.pool_min_size):
-            # Protect from exceptions
-            try:
-                # We always have at least `pool_min_size` loops in our pool
-                self.scrape()
-            except:
-                print traceback.format_exc()
-        logger.info('harakiri %s' % self)
-
     def scrape(self):
         """
-        This is called in a loop by `run` to fill-up the pool.
+        This is called by the refill scheduler to fill-up the pool.
         """
         raise NotImplementedError()
 
     @classmethod
-    def wake_up_scrapers(cls):
-        logger.info('waking up scrapers %s' % cls)
-        for i in range(1): cls().start()
+    def pool_changed(cls):
+        """
+        Must be called when loops are taken from the pool, so that it gets refilled.
+        """
+        scheduler.pool_changed(cls)
 
     def _get_free_path(self):
         """
-        This returns the filepath for the next loop to use.
+        This returns a new filepath where to save a sound, before it is added to the library.
         """
-        with self.names_lock:
-            filename = '%s%s.wav' % (self.filename_prefix, self.__class__.name_counter)
-            path = settings.app_root + 'sounds/' + filename
-            self.__class__.name_counter = (self.__class__.name_counter + 1) % 1000
-            return path
+        return library.temp_path(self.filename_prefix)
 
 
 # TODO: log thread ids
@@ -94,58 +83,30 @@ class LoopScraper(BaseScraper):
     sample_length = 20              # Length (in s.) to sample from the original sound
     filename_prefix = 'loop'
     pool_min_size = 50
+    pool_max_size = 60
+    max_scrapes = 3
     pd_loopers = {}
+    loopers_lock = threading.Lock()
     old_loops = {}
     old_loops_lock = threading.Lock()
+    loops_per_track = 11            # Maximum number of loops extracted from one track
+    prerender_count = 3             # Number of loops rendered in advance for each looper
+    pool = ShardedPool()            # Pool containing the loops, readable without locking
+    index = LoopIndex()             # Similarity index over the loops of the pool
 
     def scrape(self):
-        id_counter = 0
         track_id, filename, sound_length = get_sound()
-
-        # Check if the sound is long enough, and if yes we extract some loops from it.
-        # TODO: make this less restrictive to waste a bit less
-        if sound_length > 2 * self.sample_length:
-            offset = 0
-            upper_limit = sound_length - 2 * self.sample_length
-            while (offset + 2 * self.sample_length < upper_limit):
-
-                # Calculate a random offset where the loop will start
-                offset = random.randint(offset, int(min(offset + sound_length * 0.2, upper_limit)))
-
-                # Extracting a loop and saving it to 'loop<n>.wav'
-                sample = Sound.from_file(filename, start=offset, end=offset+self.sample_length)
-                loops = sample.extract_loops()
-                for loop in loops:
-                    if id_counter > 10:
-                        offset = upper_limit
-                        break
-                    id_counter += 1
-                    loop_id = '%s_%s' % (track_id, id_counter)
-                    loop_path = self._get_free_path()
-                    logger.info('loop extracted to %s' % loop_path)
-                    loop.to_file(loop_path)
-                    #key, key_confidence, length = loop.echonest.key, loop.echonest.key_confidence, loop.length
-
-                    with self.pool_lock:
-                        self.pool[loop_id] = dict(loop.loop_infos, **{
-                            'path': loop_path,
-                            'length': loop.length,
-                            'loop_id': loop_id,
-                            'track_id': track_id,
-                            'timbre_start': loop.loop_infos['timbre_start'],
-                            'timbre_end': loop.loop_infos['timbre_end']
-                            #'key': (key, key_confidence)
-                        })
-
-                # Increment values for next loop
-                offset += self.sample_length
-
-                # Delete the sounds to save memory
-                # We also have to collect manually because of a "bug" in pandas:
-                # https://github.com/pydata/pandas/issues/2659
-                if 'loop' in locals(): del loop
-                del sample
-                gc.collect()
+        loop_paths = [self._get_free_path() for i in range(self.loops_per_track)]
+        try:
+            loops_infos = engine.run(scrape_loops, track_id, filename, sound_length,
+                loop_paths, self.sample_length)
+        finally:
+            release_sound(filename)
+        for loop_infos in loops_infos:
+            record = LoopRecord.from_infos(loop_infos)
+            library.add_loop(record)
+            self.pool[record.loop_id] = record
+            self.index.add(record)
 
     @classmethod
     def gimme_loop_handler(cls, addr, tags, data, source):
@@ -153,107 +114,168 @@ class LoopScraper(BaseScraper):
         pd_looper_id, required_tempo, required_key = data[0], data[1], data[2]
         
         # If the track hasn't been registered yet, we do that
-        pd_looper_infos = cls.pd_loopers.setdefault(pd_looper_id, {
-            'current_loop_id': None,
-            'track_ids': [],
-            'tempo': None,
-        })
+        pd_looper_infos = cls.register_looper(pd_looper_id)
         current_loop_id = pd_looper_infos['current_loop_id']
 
-        # Picking the new loop in the pool
-        with cls.pool_lock:
-
-            # prefilter available loops (those whose track haven't been picked already)
-            available_loops = cls.pool.values()
-            forbidden_tracks = cls.forbidden_tracks(pd_looper_id)
-            available_loops = filter(lambda l: l['track_id'] not in forbidden_tracks, available_loops)
-
-            # Select the most suitable next loop according to the current loop.
-            if current_loop_id is not None:
-                def sort_key(l):
-                    timbre_dist = loop_distance(cls.old_loops[current_loop_id], l)
-                    tempo_dist = abs(1 - l['tempo'] / float(required_tempo)) * 40
-                    return timbre_dist + tempo_dist
-                loop_infos = sorted(available_loops, key=lambda l: sort_key)[0]
-            else:
-                loop_infos = available_loops[0]
-
-            # Remove the loop from the pool, reserving the loop's track for this looper
-            cls.pool.pop(loop_infos['loop_id'])
-            pd_looper_infos['track_ids'].append(loop_infos['track_id'])
-        pd_looper_infos['current_loop_id'] = loop_infos['loop_id']
+        # Picking the new loop in the pool, and reserving its track for this looper.
+        # Selection works on a snapshot of the pool, so another looper might have taken
+        # a candidate or reserved its track already. Then we try the next one.
+        loop_infos = None
+        while loop_infos is None:
+            candidates = cls.select_loops(pd_looper_id, required_tempo, 3)
+            if not candidates: raise IndexError('no loop available for looper %s' % pd_looper_id)
+            for candidate in candidates:
+                loop_infos = cls.pool.pop(candidate.loop_id, None)
+                if loop_infos is None: continue
+                if cls.reserve_track(pd_looper_id, loop_infos.track_id): break
+                # The loop is still in the index, so it is available again for the other loopers
+                cls.pool[loop_infos.loop_id] = loop_infos
+                loop_infos = None
+
+        # Remove the loop from the index and from the library
+        cls.index.remove(loop_infos.loop_id)
+        library.consume_loop(loop_infos.loop_id, loop_infos.path)
+        pd_looper_infos['current_loop_id'] = loop_infos.loop_id
 
         # Adding the picked looped to `old_loops`, so that we remember it
         # but it cannot be used again.
         with cls.old_loops_lock:
-            cls.old_loops[loop_infos['loop_id']] = loop_infos
+            cls.old_loops[loop_infos.loop_id] = loop_infos
             if current_loop_id is not None: cls.old_loops.pop(current_loop_id)
 
-        # Preparing the loop
-        logger.info('sending new loop %s to looper %s, left : %s' % (loop_infos['path'], pd_looper_id, len(cls.pool)))
-        loop = Sound.from_file(loop_infos['path'])
-        required_length = loop.length * float(required_tempo) / loop_infos['tempo']
-        beat_length = 60.0 / required_tempo
-        required_length = round(required_length / beat_length) * beat_length
-        loop = loop.time_stretch(required_length).fade(in_dur=0.002, out_dur=0.002)
-        loop.to_file(loop_infos['path'])
+        # Getting the loop stretched to the required tempo. Most of the time,
+        # it has already been rendered in the background.
+        logger.info('sending new loop %s to looper %s, left : %s' % (loop_infos.path, pd_looper_id, len(cls.pool)))
+        loop_path, loop_length = cls.renderer.get(loop_infos, required_tempo)
 
         # Sending loop, and fill-up the pool if necessary.
-        send_msg('/new_loop', pd_looper_id, loop_infos['path'], int(round(loop.length * 1000)), loop_infos['loop_id'])
-        if len(LoopScraper.pool) < LoopScraper.pool_min_size: LoopScraper.wake_up_scrapers()
+        send_msg('/new_loop', pd_looper_id, loop_path, int(round(loop_length * 1000)), loop_infos.loop_id)
+        LoopScraper.pool_changed()
+
+        # The looper will probably ask for its next loop at the same tempo,
+        # so we prepare the best candidates.
+        pd_looper_infos['tempo'] = required_tempo
+        cls.renderer.wake_up()
+
+    @classmethod
+    def select_loops(cls, pd_looper_id, required_tempo, count):
+        """
+        Returns the `count` loops from the pool which are the most suitable
+        to follow the current loop of looper `pd_looper_id`, best first.
+        """
+        current_loop_infos = cls.old_loops.get(cls.pd_loopers[pd_looper_id]['current_loop_id'])
+        if current_loop_infos is not None: timbre_start = current_loop_infos.timbre_start
+        else: timbre_start = None
+        loop_ids = cls.index.best(timbre_start, required_tempo, count,
+            forbidden_tracks=cls.forbidden_tracks(pd_looper_id))
+        loops_infos = [cls.pool.get(loop_id) for loop_id in loop_ids]
+        return [loop_infos for loop_infos in loops_infos if loop_infos is not None]
+
+    @classmethod
+    def prerender_candidates(cls):
+        """
+        Returns the `(loop_infos, tempo)` that the loopers are likely to ask for next.
+        """
+        candidates = []
+        for pd_looper_id, pd_looper_infos in cls.pd_loopers.items():
+            if pd_looper_infos['tempo'] is None: continue
+            for loop_infos in cls.select_loops(pd_looper_id, pd_looper_infos['tempo'], cls.prerender_count):
+                candidates.append((loop_infos, pd_looper_infos['tempo']))
+        return candidates
+
+    @classmethod
+    def register_looper(cls, looper_id):
+        """
+        Registers the looper `looper_id` if it isn't yet, and returns its infos.
+        """
+        with cls.loopers_lock:
+            if looper_id not in cls.pd_loopers:
+                forbidden_tracks = set()
+                for pd_looper_infos in cls.pd_loopers.values():
+                    forbidden_tracks.update(pd_looper_infos['track_ids'])
+                cls.pd_loopers[looper_id] = {
+                    'current_loop_id': None,
+                    'track_ids': [],
+                    'tempo': None,
+                    'forbidden_tracks': frozenset(forbidden_tracks)
+                }
+            return cls.pd_loopers[looper_id]
+
+    @classmethod
+    def reserve_track(cls, looper_id, track_id):
+        """
+        Reserves the track `track_id` for the looper `looper_id`, so that other loopers cannot use it.
+        Returns False, without reserving it, if the track is reserved by another looper.
+        """
+        with cls.loopers_lock:
+            if track_id in cls.pd_loopers[looper_id]['forbidden_tracks']: return False
+            cls.pd_loopers[looper_id]['track_ids'].append(track_id)
+            for other_looper_id, pd_looper_infos in cls.pd_loopers.items():
+                if other_looper_id == looper_id: continue
+                # Sets are replaced rather than modified, because they are read without lock
+                pd_looper_infos['forbidden_tracks'] = pd_looper_infos['forbidden_tracks'] | set([track_id])
+            return True
 
     @classmethod
     def forbidden_tracks(cls, looper_id):
         """
-        Returns a list of the tracks that the looper `looper_id` cannot use
+        Returns the set of the tracks that the looper `looper_id` cannot use
         """
-        loopers_infos = dict(**cls.pd_loopers)
-        loopers_infos.pop(looper_id)
-        track_ids = []
-        return reduce(lambda memo, elem: memo + elem['track_ids'], loopers_infos.values(), [])
+        return cls.pd_loopers[looper_id]['forbidden_tracks']
+
+
+LoopScraper.renderer = PreRenderer(LoopScraper.prerender_candidates)
 
 
 class PadScraper(BaseScraper):
 
     pool_min_size = 3
+    pool_max_size = 4
+    max_scrapes = 2
     filename_prefix = 'pad'
 
     def scrape(self):
         track_id, pad_path, pad_length = get_sound()
-        new_pad_path = self._get_free_path()
-        pad_id = '%s' % (track_id)
-        sound = Sound.from_file(pad_path, end=min(30, pad_length))
-        sound = sound.remove_beats()
-        sound.to_file(new_pad_path)
-        logger.info('pad extracted to %s' % new_pad_path)
-        '''pad.to_file(pad_path)
-
-        # Delete the sound to save memory
-        # We also have to collect manually because of a "bug" in pandas:
-        # https://github.com/pydata/pandas/issues/2659 
-        del pad
-        gc.collect()'''
-
+        try:
+            pad_infos = engine.run(scrape_pad, track_id, pad_path, pad_length, self._get_free_path())
+        finally:
+            release_sound(pad_path)
+        library.add_pad(pad_infos)
         with self.pool_lock:
-            self.pool[pad_id] = {
-                'path': new_pad_path,
-                'pad_id': pad_id
-            }
+            self.pool[pad_infos['pad_id']] = pad_infos
         
     @classmethod
     def gimme_pad_handler(cls, addr, tags, data, source):
         with cls.pool_lock:
             pad_infos = cls.pool.values().pop(0)
             cls.pool.pop(pad_infos['pad_id'])
+        library.consume_pad(pad_infos['pad_id'], pad_infos['path'])
         logger.info('sending new pad %s, still %s in pool' % (pad_infos['path'], len(cls.pool)))
         send_msg('/new_pad', pad_infos['path'])
-        if len(PadScraper.pool) < PadScraper.pool_min_size: PadScraper.wake_up_scrapers()
+        PadScraper.pool_changed()
 
 
 if __name__ == '__main__':
-    # Start scrapers
-    for i in range(3): LoopScraper().start()
-    for i in range(2): PadScraper().start()
+    # Start the scraping and rendering processes, before any thread is started.
+    # The rendering processes are forked after the scraping pool has started its
+    # handler threads, which is safe (see `ScrapingEngine.start`).
+    engine.start()
+    render_engine.start()
+
+    # Fill the pools with the sounds left in the library by the previous runs
+    library.purge()
+    records = library.loops()
+    LoopScraper.pool.update((record.loop_id, record) for record in records)
+    LoopScraper.index.add_many(records)
+    for pad_infos in library.pads(): PadScraper.pool[pad_infos['pad_id']] = pad_infos
+    library.start()
+    logger.info('*INIT* %s loops and %s pads loaded from the library' % (len(LoopScraper.pool), len(PadScraper.pool)))
+
+    # Start scrapers, and the renderer preparing loops in advance
+    scheduler.start()
+    LoopScraper.pool_changed()
+    PadScraper.pool_changed()
+    LoopScraper.renderer.start()
 
     # Start server
     server = OSC.OSCServer(('localhost', 9000))
@@ -265,9 +287,32 @@ if __name__ == '__main__':
     def init_handler(addr, tags, data, source):
         logger.info('*INIT* send init infos to the pd patch')
         send_msg('/init/pwd', settings.icecast_password)
-    server.addMsgHandler('/init', init_handler)
-    server.addMsgHandler('/gimme_loop', LoopScraper.gimme_loop_handler)
-    server.addMsgHandler('/gimme_pad', PadScraper.gimme_pad_handler)
+
+    # Metrics are sent back to the client which asked for them, as one message
+    # per metric, and dumped to a file in the Prometheus text format.
+    metrics.gauge('loop_pool_size', lambda: len(LoopScraper.pool))
+    metrics.gauge('pad_pool_size', lambda: len(PadScraper.pool))
+    metrics.gauge('download_queue_size', lambda: downloader.tracks.qsize())
+    metrics.gauge('scrapers_busy', lambda: scheduler.busy)
+    metrics.gauge('scrapers_utilization', lambda: scheduler.busy / float(scheduler.workers))
+    metrics.gauge('prerender_hits', lambda: LoopScraper.renderer.hits)
+    metrics.gauge('prerender_misses', lambda: LoopScraper.renderer.misses)
+    metrics_path = getattr(settings, 'metrics_path', settings.app_root + 'metrics.prom')
+    def metrics_handler(addr, tags, data, source):
+        reply = OSCSender(source)
+        with reply.bundle():
+            for name, values in metrics.summary(): reply.send('/metrics', name, *values)
+        metrics.dump_to_file(metrics_path)
+
+    # Handlers are run by the dispatcher, so that the server thread is always free
+    # to receive messages. Loops can be prepared for several loopers at once.
+    concurrency = dict({'/init': 1, '/gimme_loop': 2, '/gimme_pad': 1, '/metrics': 1},
+        **getattr(settings, 'handlers_concurrency', {}))
+    dispatcher = Dispatcher()
+    dispatcher.add_handler(server, '/init', init_handler, concurrency['/init'])
+    dispatcher.add_handler(server, '/gimme_loop', LoopScraper.gimme_loop_handler, concurrency['/gimme_loop'])
+    dispatcher.add_handler(server, '/gimme_pad', PadScraper.gimme_pad_handler, concurrency['/gimme_pad'])
+    dispatcher.add_handler(server, '/metrics', metrics_handler, concurrency['/metrics'])
 
     # Starting the OSC server in a new thread
     def init_server():
@@ -301,4 +346,5 @@ if __name__ == '__main__':
         q = Queue()
         try: q.get(True, 30)
         except Empty: pass
+        metrics.dump_to_file(metrics_path)
         #print hp.heap()
@@ -0,0 +1,64 @@
+import threading
+import traceback
+from Queue import Queue
+import logging
+logger = logging.getLogger('versificator')
+
+import settings
+
+
+class RefillScheduler(object):
+    """
+    Keeps the pools of the scrapers filled, with a fixed set of worker threads.
+    When a pool goes under its low watermark `pool_min_size`, scraping jobs are queued
+    for it until it reaches its high watermark `pool_max_size`. At most `max_scrapes`
+    jobs are queued or running for a given pool.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None: workers = getattr(settings, 'scraper_threads', 5)
+        self.workers = workers
+        self.busy = 0                   # Number of workers currently scraping
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._refilling = set()         # Scraper classes whose pool is being refilled
+        self._jobs = {}                 # {scraper class: number of queued or running jobs}
+
+    def start(self):
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def pool_changed(self, scraper_cls):
+        """
+        Must be called when the size of the pool of `scraper_cls` changes.
+        """
+        with self._lock:
+            size = len(scraper_cls.pool)
+            if size < scraper_cls.pool_min_size:
+                if scraper_cls not in self._refilling:
+                    logger.info('refilling pool %s, size : %s' % (scraper_cls.__name__, size))
+                self._refilling.add(scraper_cls)
+            elif size >= scraper_cls.pool_max_size:
+                self._refilling.discard(scraper_cls)
+            if scraper_cls not in self._refilling: return
+            while self._jobs.get(scraper_cls, 0) < scraper_cls.max_scrapes:
+                self._jobs[scraper_cls] = self._jobs.get(scraper_cls, 0) + 1
+                self._queue.put(scraper_cls)
+
+    def _work(self):
+        while True:
+            scraper_cls = self._queue.get()
+            with self._lock: self.busy += 1
+            try:
+                scraper_cls().scrape()
+            except:
+                print traceback.format_exc()
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self._jobs[scraper_cls] -= 1
+            self.pool_changed(scraper_cls)
+
+scheduler = RefillScheduler()
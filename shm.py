@@ -0,0 +1,122 @@
+"""
+Handoff of the rendered loops to Pd through shared memory. Loops are written
+in a ring of preallocated wav files in a memory filesystem (`/dev/shm` by default),
+so Pd's `soundfiler` loads them without any disk I/O.
+"""
+import os
+import mmap
+import struct
+import collections
+import threading
+
+import numpy as np
+
+import settings
+
+WAV_HEADER_SIZE = 44
+
+
+def write_slot(path, frames, sample_rate):
+    """
+    Writes `frames` as a 16-bit wav in the slot file `path`, through a memory map.
+    The slot is grown if it is too small for the frames. Returns the length written, in seconds.
+    """
+    frames = np.asarray(frames)
+    if frames.ndim == 1: frames = frames[:, np.newaxis]
+    frame_count, channel_count = frames.shape
+    data_size = frame_count * channel_count * 2
+    header = struct.pack('<4sI4s4sIHHIIHH4sI', 'RIFF', 36 + data_size, 'WAVE',
+        'fmt ', 16, 1, channel_count, sample_rate, sample_rate * channel_count * 2, channel_count * 2, 16,
+        'data', data_size)
+
+    slot_file = open(path, 'r+b')
+    try:
+        if os.fstat(slot_file.fileno()).st_size < WAV_HEADER_SIZE + data_size:
+            slot_file.truncate(WAV_HEADER_SIZE + data_size)
+        slot = mmap.mmap(slot_file.fileno(), WAV_HEADER_SIZE + data_size)
+        try:
+            slot[:WAV_HEADER_SIZE] = header
+            samples = np.frombuffer(slot, dtype='<i2', count=frame_count * channel_count, offset=WAV_HEADER_SIZE)
+            np.multiply(np.clip(frames, -1, 1), 32767, out=samples.reshape(frames.shape), casting='unsafe')
+            del samples
+        finally:
+            slot.close()
+    finally:
+        slot_file.close()
+    return frame_count / float(sample_rate)
+
+
+class ShmRing(object):
+    """
+    Ring of `slot_count` preallocated wav files of `slot_bytes` bytes each, in `directory`.
+    It is used like a `RenderCache`: renderings are keyed, and when all the slots are
+    taken, the least recently used one is reused. Renderings must be written with `write_slot`.
+    """
+
+    in_place = True     # Renderings are written in the existing files
+
+    def __init__(self, directory=None, slot_count=None, slot_bytes=None):
+        if directory is None: directory = getattr(settings, 'shm_directory', '/dev/shm/versificator/')
+        if slot_count is None: slot_count = getattr(settings, 'shm_slot_count', 32)
+        if slot_bytes is None: slot_bytes = getattr(settings, 'shm_slot_bytes', 4 * 1024 * 1024)
+        self.directory = directory
+        self.slot_count = slot_count
+        self.slot_bytes = slot_bytes
+        self._slots = collections.OrderedDict()     # {slot: key}, least recently used first
+        self._assigned = {}                         # {key: slot}
+        self._entries = {}                          # {key: (path, length)}, renderings ready
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """
+        Creates the slot files, and forgets all the renderings.
+        """
+        with self._lock:
+            if not os.path.exists(self.directory): os.makedirs(self.directory)
+            for slot in range(self.slot_count):
+                slot_file = open(self._path(slot), 'wb')
+                try: slot_file.truncate(self.slot_bytes)
+                finally: slot_file.close()
+            self._slots = collections.OrderedDict((slot, None) for slot in range(self.slot_count))
+            self._assigned.clear()
+            self._entries.clear()
+
+    def path_for(self, key):
+        """
+        Assigns a slot to the rendering `key`, and returns the path of its file.
+        """
+        with self._lock:
+            if key in self._assigned: return self._path(self._assigned[key])
+            slot, old_key = self._slots.popitem(last=False)
+            if old_key is not None:
+                self._assigned.pop(old_key, None)
+                self._entries.pop(old_key, None)
+            self._slots[slot] = key
+            self._assigned[key] = slot
+            return self._path(slot)
+
+    def get(self, key):
+        """
+        Returns `(path, length)` of the rendering `key`, or `None` if it isn't in the ring.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            slot = self._assigned[key]
+            self._slots[slot] = self._slots.pop(slot)
+            return entry
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def add(self, key, length):
+        """
+        Adds the rendering `key`, which must have been written in `path_for(key)`.
+        """
+        with self._lock:
+            # The slot might have been taken in the meantime by another rendering
+            if key not in self._assigned: return
+            self._entries[key] = (self._path(self._assigned[key]), length)
+
+    def _path(self, slot):
+        return os.path.join(self.directory, 'slot%s.wav' % slot)
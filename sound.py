@@ -1,73 +1,270 @@
+import os
+import wave
+import tempfile
+import subprocess
 import numpy as np
 
 from pychedelic import Sound as PycheSound
-from tools import euclidian_distance
+from analysis import Analysis
+from metrics import metrics
 
 import settings
 from pyechonest import config
 config.ECHO_NEST_API_KEY = settings.echonest_api_key
 
 
+TIMBRE_SIZE = 12
+
+# Features calculated for each bar by `score_bars`.
+# Segment positions are positions in a `SegmentIndex`, -1 if there is no segment.
+BAR_FEATURES = np.dtype([
+    ('start', float),
+    ('duration', float),
+    ('segment_count', int),
+    ('first_segment', int),
+    ('last_segment', int),
+    ('loop_quality', float),
+    ('timbre_start', float, (TIMBRE_SIZE,)),
+    ('timbre_end', float, (TIMBRE_SIZE,)),
+])
+
+
+class SegmentIndex(object):
+    """
+    Interval index over the segments of an analysis. Segments are sorted once,
+    and the segments overlapping the boundaries of a bar are found with a binary
+    search on the start times. This assumes the segments don't overlap each other,
+    which is the case for the segments returned by the Echo Nest.
+    """
+
+    def __init__(self, segments):
+        order = np.argsort([seg['start'] for seg in segments], kind='mergesort')
+        self.segments = [segments[i] for i in order]
+        self.starts = np.array([seg['start'] for seg in self.segments], dtype=float)
+        self.ends = self.starts + np.array([seg['duration'] for seg in self.segments], dtype=float)
+        self.timbres = np.array([seg['timbre'] for seg in self.segments], dtype=float).reshape(-1, TIMBRE_SIZE)
+
+    def containing(self, times):
+        """
+        Returns, for each time in `times`, the position of the segment strictly containing it,
+        or -1 if there is no such segment.
+        """
+        times = np.asarray(times, dtype=float)
+        positions = np.searchsorted(self.starts, times, side='left') - 1
+        clipped = np.clip(positions, 0, max(len(self.starts) - 1, 0))
+        if len(self.starts):
+            inside = (positions >= 0) & (times < self.ends[clipped])
+        else:
+            inside = np.zeros(times.shape, dtype=bool)
+        return np.where(inside, positions, -1)
+
+    def overlapping(self, bar_starts, bar_ends):
+        """
+        Vectorized lookup for many bars at once. Returns 3 arrays `(first, last, count)`
+        giving the positions of the first and last segments overlapping each bar
+        (-1 if there is none), and the number of overlapping segments.
+        """
+        at_start = self.containing(bar_starts)
+        at_end = self.containing(bar_ends)
+        first = np.where(at_start >= 0, at_start, at_end)
+        last = np.where(at_end >= 0, at_end, at_start)
+        count = ((at_start >= 0).astype(int) + (at_end >= 0).astype(int)
+            - ((at_start == at_end) & (at_start >= 0)).astype(int))
+        return first, last, count
+
+    def between(self, first, last):
+        """
+        Returns the segments at positions `first` and `last`, as returned by `overlapping`.
+        """
+        return [self.segments[i] for i in sorted(set([first, last])) if i >= 0]
+
+
+def score_bars(bars, index):
+    """
+    Calculates the features of all `bars` in a single pass, and returns them
+    as a structured array of dtype `BAR_FEATURES`. `index` is the `SegmentIndex`
+    of the analysis the bars come from.
+    """
+    features = np.zeros(len(bars), dtype=BAR_FEATURES)
+    features['start'] = [bar_infos['start'] for bar_infos in bars]
+    features['duration'] = [bar_infos['duration'] for bar_infos in bars]
+    first, last, count = index.overlapping(features['start'], features['start'] + features['duration'])
+    features['first_segment'] = first
+    features['last_segment'] = last
+    features['segment_count'] = count
+
+    # Timbre values at the start of the loop, and at the end of the loop. 
+    has_segments = count > 0
+    features['timbre_start'][has_segments] = index.timbres[first[has_segments]]
+    features['timbre_end'][has_segments] = index.timbres[last[has_segments]]
+
+    # Loop quality is the timbral distance between the 2 segments at the boundaries of the bar.
+    # A bar inside a single segment makes a perfect loop, a bar overlapping 
+    # more segments doesn't make a loop at all.
+    diff = features['timbre_start'] - features['timbre_end']
+    distances = np.sqrt((diff * diff).sum(axis=1))
+    features['loop_quality'] = np.where(count == 1, 0, np.where(count == 2, distances, 100000))
+    return features
+
+
+def loop_bars(analysis, count=None, max_quality=60):
+    """
+    Returns the infos of the bars of `analysis` that make good loops, like `Sound.loop_bars`,
+    but straight from the analysis, without any audio. If `count` is given, only
+    the `count` best ones are returned, in the order of the analysis.
+    """
+    features = score_bars(analysis.bars, SegmentIndex(analysis.segments))
+    selected = np.flatnonzero(features['loop_quality'] < max_quality)
+    if count is not None:
+        best = selected[np.argsort(features['loop_quality'][selected], kind='mergesort')[:count]]
+        selected = best[np.argsort(features['start'][best], kind='mergesort')]
+    return [{
+        'start': float(bar_features['start']),
+        'duration': float(bar_features['duration']),
+        'tempo': analysis.tempo,
+        'loop_quality': float(bar_features['loop_quality']),
+        'timbre_start': bar_features['timbre_start'].tolist(),
+        'timbre_end': bar_features['timbre_end'].tolist()
+    } for bar_features in features[selected]]
+
+
+def in_intervals(times, intervals):
+    """
+    Returns a mask telling for each time in `times` whether it is strictly inside
+    one of the `intervals`, given as a list of `(start, end)`.
+    """
+    intervals = np.array([(start, end) for start, end in intervals if start < end], dtype=float).reshape(-1, 2)
+    if not len(intervals): return np.zeros(len(times), dtype=bool)
+    intervals = intervals[np.argsort(intervals[:, 0], kind='mergesort')]
+    starts, ends = intervals[:, 0], np.maximum.accumulate(intervals[:, 1])
+
+    # Merges overlapping intervals. Intervals which only touch are kept separate,
+    # because the time at which they touch is in neither of them.
+    group_starts = np.ones(len(starts), dtype=bool)
+    group_starts[1:] = starts[1:] >= ends[:-1]
+    group_ends = np.append(np.flatnonzero(group_starts)[1:] - 1, len(starts) - 1).astype(int)
+    starts, ends = starts[group_starts], ends[group_ends]
+
+    positions = np.searchsorted(starts, times, side='left') - 1
+    return (positions >= 0) & (times < ends[np.clip(positions, 0, max(len(ends) - 1, 0))])
+
+
+def crossfade(chunks, fade_length):
+    """
+    Concatenates `chunks` of samples, crossfading each chunk with the next over `fade_length` samples.
+    """
+    pieces, current = [], chunks[0]
+    for chunk in chunks[1:]:
+        length = min(fade_length, len(current), len(chunk))
+        ramp = np.linspace(0, 1, length).reshape((length,) + (1,) * (chunk.ndim - 1))
+        pieces.append(current[:len(current) - length])
+        pieces.append(current[len(current) - length:] * (1 - ramp) + chunk[:length] * ramp)
+        current = chunk[length:]
+    pieces.append(current)
+    return np.concatenate(pieces)
+
+
 class Sound(PycheSound):
 
+    # Analysis and shape of the audio for which the bars have been enriched,
+    # and number of times the enrichment ran for this sound.
+    _enriched_analysis = None
+    _enriched_shape = None
+    enrichment_count = 0
+
+    @property
+    def segment_index(self):
+        """
+        The `SegmentIndex` for the current analysis. It is built only once per analysis.
+        """
+        index = getattr(self, '_segment_index', None)
+        if index is None or index.analysis is not self._echonest:
+            index = SegmentIndex(self._echonest.segments)
+            index.analysis = self._echonest
+            self._segment_index = index
+        return index
+
+    def cached_analysis(self, cache, *key):
+        """
+        Uses the analysis stored in `cache` under `key` if there is one,
+        otherwise analyses the sound and stores the analysis in `cache`.
+        """
+        analysis = cache.get(*key)
+        if analysis is None:
+            analysis = self.analyse()
+            cache.put(analysis, *key)
+        self._echonest = analysis
+        return analysis
+
+    def analyse(self):
+        """
+        Analyses the sound with the backend chosen with `settings.analysis_backend` :
+        'echonest' (the default) uploads it to the Echo Nest, 'local' analyses it in this process.
+        """
+        if self._local_analysis(): return Analysis.from_frames(self.values, self.sample_rate)
+        return Analysis.from_echonest(super(Sound, self).echonest)
+
+    def _local_analysis(self):
+        return getattr(settings, 'analysis_backend', 'echonest') == 'local'
+
     def get_overlapping_segments(self, bar):
         """
         Returns the list of segments overlapping `bar` sorted by starting time. 
         """
         bar_start = bar['start']
         bar_end = bar_start + bar['duration']
-        segments = sorted(self._echonest.segments, key=lambda seg: seg['start'])
-        overlapping_segments = []
-        for seg in segments:
-            seg_start = seg['start']
-            seg_end = seg['start'] + seg['duration']
-            if seg_start > bar_end: break
-            if ((bar_start > seg_start and bar_start < seg_end)
-              or (bar_end > seg_start and bar_end < seg_end)):
-                overlapping_segments.append(seg)
-        return overlapping_segments
+        index = self.segment_index
+        first, last, count = index.overlapping([bar_start], [bar_end])
+        return index.between(first[0], last[0])
 
     @property
     def echonest(self):
         """
-        Calculates some extra attributes for all bars.
+        Calculates some extra attributes for all bars. This is done only once per sound,
+        and done again only if the analysis or the audio changes.
         """
+        if self._local_analysis() and getattr(self, '_echonest', None) is None:
+            self._echonest = self.analyse()
         echonest = super(Sound, self).echonest
-        for bar_infos in echonest.bars:
-            segments = self.get_overlapping_segments(bar_infos)
+        if self._enriched_analysis is echonest and self._enriched_shape == self.shape:
+            return echonest
+        index = self.segment_index
+        features = score_bars(echonest.bars, index)
+        for bar_infos, bar_features in zip(echonest.bars, features):
             bar_infos['tempo'] = echonest.tempo
-
-            # Calculates a loop quality attribute
-            if len(segments) == 1:
-                bar_infos['loop_quality'] = 0
-            elif len(segments) == 2:
-                bar_infos['loop_quality'] = euclidian_distance(
-                    np.array(segments[0]['timbre']),
-                    np.array(segments[1]['timbre'])
-                )
-            else:
-                bar_infos['loop_quality'] = 100000
-
-            # Calculates the timbre values at the start of the loop,
-            # and at the end of the loop. 
-            if segments:            
-                bar_infos['timbre_start'] = segments[0]['timbre']
-                bar_infos['timbre_end'] = segments[-1]['timbre']
+            bar_infos['loop_quality'] = float(bar_features['loop_quality'])
+            if bar_features['segment_count']:
+                bar_infos['timbre_start'] = index.segments[bar_features['first_segment']]['timbre']
+                bar_infos['timbre_end'] = index.segments[bar_features['last_segment']]['timbre']
             else:
                 bar_infos['timbre_start'] = None
                 bar_infos['timbre_end'] = None
+
+        self._enriched_analysis = echonest
+        self._enriched_shape = self.shape
+        self.enrichment_count += 1
         return echonest
 
     def loop_from_bar_infos(self, bar_infos):
         return self.ix[float(bar_infos['start']):float(bar_infos['start']+bar_infos['duration'])]
 
-    def extract_loops(self):
+    def loop_bars(self, count=None):
         """
-        Takes a sound and extracts a loop from it. If no loop could be extracted, `None` is returned.
+        Returns the infos of the bars that make good loops. If `count` is given,
+        only the `count` best ones are returned, in the order of the sound.
+        """
+        bars_infos = filter(lambda bar_info: bar_info['loop_quality'] < 60, self.echonest.bars)
+        if count is None: return bars_infos
+        best = sorted(bars_infos, key=lambda bar_info: bar_info['loop_quality'])[:count]
+        return sorted(best, key=lambda bar_info: bar_info['start'])
+
+    def extract_loops(self, count=None):
+        """
+        Takes a sound and extracts loops from it, only the `count` best ones if given.
+        If no loop could be extracted, an empty list is returned.
         """
         # Filter only bars that make good loops
-        bars_infos = self.echonest.bars
-        bars_infos = filter(lambda bar_info: bar_info['loop_quality'] < 60, bars_infos)
+        bars_infos = self.loop_bars(count)
         if not bars_infos: return []
         else:
             loops = []
@@ -77,12 +274,94 @@ class Sound(PycheSound):
                 loops.append(loop)
             return loops
 
-    def remove_beats(self):
+    def remove_beats(self, fade=0):
+        """
+        Removes the beats from the sound. If `fade` (in seconds) is given,
+        the sound is crossfaded over that duration at each cut, so it doesn't click.
+        """
+        # The intervals are `(start, duration)` and not `(start, end)`, as they always were.
+        # Beats cover the whole sound, so removing them all would leave nothing. With this,
+        # every interval after the first one is empty, and only the first beat is removed.
         beat_times = [(b['start'], b['duration']) for b in self.echonest.beats]
-        def criterion(time):
-            for start, end in beat_times:
-                if time > start and time < end:
-                    return False
-            return True
-        return self._constructor(self.select(criterion, axis=0).values)
-            
+        keep = ~in_intervals(np.asarray(self.index, dtype=float), beat_times)
+        values = self.values[keep]
+        fade_length = int(fade * self.sample_rate)
+        if fade_length:
+            # Positions in `values` where samples have been removed
+            cuts = np.flatnonzero(np.diff(np.flatnonzero(keep)) > 1) + 1
+            values = crossfade(np.split(values, cuts), fade_length)
+        return self._constructor(values)
+
+
+class Track(object):
+    """
+    A sound file decoded only once, to a temporary file of raw float32 frames
+    which is memory-mapped. Windows of the track are then views on that memory,
+    so sampling many windows doesn't decode the file again, and portions of the
+    track are written to disk without going through a `Sound`.
+    """
+
+    def __init__(self, filename, sample_rate=44100, channel_count=2):
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.channel_count = channel_count
+        fd, self.raw_path = tempfile.mkstemp(suffix='.f32')
+        os.close(fd)
+        try:
+            with open(os.devnull, 'w') as devnull, metrics.timer('decode_seconds'):
+                subprocess.check_call([getattr(settings, 'decoder', 'ffmpeg'), '-y', '-i', filename,
+                    '-f', 'f32le', '-acodec', 'pcm_f32le', '-ar', str(sample_rate),
+                    '-ac', str(channel_count), self.raw_path], stdout=devnull, stderr=devnull)
+        except:
+            # The track cannot be used, so `close` is never called. The raw file,
+            # maybe partly written, must be removed here.
+            os.remove(self.raw_path)
+            raise
+        if os.path.getsize(self.raw_path):
+            # Copy-on-write, so that operations on the windows never touch the file
+            self.frames = np.memmap(self.raw_path, dtype='float32', mode='c').reshape(-1, channel_count)
+        else: self.frames = np.zeros((0, channel_count), dtype='float32')
+
+    @property
+    def length(self):
+        return len(self.frames) / float(self.sample_rate)
+
+    def window(self, start, end, analysis=None):
+        """
+        Returns the portion of the track between `start` and `end` (in seconds) as a `Sound`.
+        If the `analysis` of the whole track is given, the window's analysis is sliced from it.
+        """
+        frames = self.frames[int(start * self.sample_rate):int(end * self.sample_rate)]
+        sound = Sound(frames, sample_rate=self.sample_rate)
+        if analysis is not None: sound._echonest = analysis.slice(start, end)
+        return sound
+
+    def write(self, start, end, path, block_size=65536):
+        """
+        Writes the portion of the track between `start` and `end` (in seconds)
+        to the wav file `path`, `block_size` frames at a time, so that only
+        one block is in memory. Returns the length written, in seconds.
+        """
+        first = int(start * self.sample_rate)
+        last = min(int(end * self.sample_rate), len(self.frames))
+        wav_file = wave.open(path, 'wb')
+        try:
+            wav_file.setnchannels(self.channel_count)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(self.sample_rate)
+            for position in xrange(first, last, block_size):
+                block = self.frames[position:min(position + block_size, last)]
+                wav_file.writeframes((np.clip(block, -1, 1) * 32767).astype('<i2').tostring())
+        finally:
+            wav_file.close()
+        return max(last - first, 0) / float(self.sample_rate)
+
+    def close(self):
+        self.frames = None
+        if os.path.exists(self.raw_path): os.remove(self.raw_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
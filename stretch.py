@@ -0,0 +1,121 @@
+"""
+Time-stretching of loops. Depending on how much a loop must be stretched,
+it is left untouched, simply resampled, or stretched with a phase vocoder.
+"""
+import numpy as np
+
+import settings
+
+FFT_SIZE = 2048
+HOP_SIZE = FFT_SIZE // 4
+
+
+def tempo_length(length, loop_tempo, required_tempo):
+    """
+    Returns the length (in s.) a loop of `length` at `loop_tempo` must have
+    to be played at `required_tempo`, rounded to a whole number of beats.
+    """
+    required_length = length * float(required_tempo) / loop_tempo
+    beat_length = 60.0 / required_tempo
+    return round(required_length / beat_length) * beat_length
+
+
+def stretch(frames, sample_rate, length, resample_threshold=None):
+    """
+    Stretches `frames`, an array of samples of shape (frame count, channel count),
+    to `length` seconds. If the stretch ratio is within `resample_threshold` of 1,
+    frames are just resampled, which changes the pitch by that much.
+    """
+    return _stretch(frames, int(round(length * sample_rate)), resample_threshold)
+
+
+def stretch_batch(loops, sample_rate, required_tempo, resample_threshold=None):
+    """
+    Stretches many loops to the same `required_tempo`. `loops` is a list of
+    `(frames, loop_tempo)`, and the list of stretched frames is returned.
+    Loops which have the same length before and after stretching (e.g. loops
+    from the same track) are stacked and stretched together.
+    """
+    groups = {}
+    for position, (frames, loop_tempo) in enumerate(loops):
+        length = tempo_length(len(frames) / float(sample_rate), loop_tempo, required_tempo)
+        groups.setdefault((len(frames), int(round(length * sample_rate))), []).append(position)
+
+    stretched = [None] * len(loops)
+    for (initial_count, frame_count), positions in groups.items():
+        group = [np.asarray(loops[position][0]).reshape(initial_count, -1) for position in positions]
+        frames = _stretch(np.concatenate(group, axis=1), frame_count, resample_threshold)
+        splits = np.cumsum([channels.shape[1] for channels in group])[:-1]
+        for position, channels in zip(positions, np.split(frames, splits, axis=1)):
+            stretched[position] = channels.reshape((frame_count,) + np.shape(loops[position][0])[1:])
+    return stretched
+
+
+def _stretch(frames, frame_count, resample_threshold):
+    if resample_threshold is None:
+        resample_threshold = getattr(settings, 'stretch_resample_threshold', 0.01)
+    if frame_count == len(frames): return frames
+    ratio = frame_count / float(len(frames))
+    if abs(ratio - 1) <= resample_threshold: return resample(frames, frame_count)
+    return phase_vocoder(frames, frame_count)
+
+
+def resample(frames, frame_count):
+    """
+    Resamples `frames` to `frame_count` frames with linear interpolation.
+    """
+    frames = np.asarray(frames, dtype=float)
+    positions = np.linspace(0, len(frames) - 1, frame_count)
+    previous = np.floor(positions).astype(int)
+    following = np.minimum(previous + 1, len(frames) - 1)
+    weights = (positions - previous).reshape((-1,) + (1,) * (frames.ndim - 1))
+    return frames[previous] * (1 - weights) + frames[following] * weights
+
+
+def phase_vocoder(frames, frame_count, fft_size=FFT_SIZE, hop_size=HOP_SIZE):
+    """
+    Stretches `frames` to `frame_count` frames with a phase vocoder. All the analysis
+    frames are transformed at once, and phases are accumulated with a cumulative sum,
+    so there is no Python loop over the frames.
+    """
+    frames = np.asarray(frames, dtype=float)
+    squeeze = frames.ndim == 1
+    if squeeze: frames = frames[:, np.newaxis]
+    channel_count = frames.shape[1]
+    ratio = frame_count / float(len(frames))
+    window = np.hanning(fft_size + 1)[:-1]
+    overlap = fft_size // hop_size
+
+    # Analysis : frames centered on multiples of `hop_size`
+    padded = np.concatenate([np.zeros((fft_size // 2, channel_count)), frames,
+        np.zeros((fft_size, channel_count))])
+    analysis_count = len(frames) // hop_size + 2
+    indices = np.arange(fft_size)[np.newaxis, :] + hop_size * np.arange(analysis_count)[:, np.newaxis]
+    spectrum = np.fft.rfft(padded[indices] * window[np.newaxis, :, np.newaxis], axis=1)
+
+    # For each synthesis frame, position in the analysis frames
+    synthesis_count = frame_count // hop_size + 2
+    steps = np.minimum(np.arange(synthesis_count) / ratio, analysis_count - 1.000001)
+    previous = np.floor(steps).astype(int)
+    weights = (steps - previous)[:, np.newaxis, np.newaxis]
+    magnitudes = (1 - weights) * np.abs(spectrum[previous]) + weights * np.abs(spectrum[previous + 1])
+
+    # Phase advance between consecutive analysis frames, unwrapped around the expected advance
+    expected = 2 * np.pi * hop_size * np.arange(spectrum.shape[1]) / fft_size
+    expected = expected[np.newaxis, :, np.newaxis]
+    advance = np.angle(spectrum[previous + 1]) - np.angle(spectrum[previous]) - expected
+    advance = expected + advance - 2 * np.pi * np.round(advance / (2 * np.pi))
+    phases = np.angle(spectrum[0])[np.newaxis] + np.concatenate(
+        [np.zeros((1,) + advance.shape[1:]), np.cumsum(advance[:-1], axis=0)])
+
+    # Synthesis : overlap-add of the windowed frames, normalized by the sum of squared windows.
+    synthesized = np.fft.irfft(magnitudes * np.exp(1j * phases), fft_size, axis=1)
+    synthesized *= window[np.newaxis, :, np.newaxis]
+    output = np.zeros((synthesis_count + overlap - 1, hop_size, channel_count))
+    norm = np.zeros((synthesis_count + overlap - 1, hop_size))
+    for part in range(overlap):
+        output[part:part + synthesis_count] += synthesized[:, part * hop_size:(part + 1) * hop_size]
+        norm[part:part + synthesis_count] += window[part * hop_size:(part + 1) * hop_size] ** 2
+    output = output.reshape(-1, channel_count) / np.maximum(norm.reshape(-1, 1), 1e-8)
+    output = output[fft_size // 2:fft_size // 2 + frame_count]
+    return output[:, 0] if squeeze else output
@@ -2,10 +2,11 @@ import time
 import random
 random.seed(time.time())
 import os
+import threading
+import contextlib
 import OSC
 import requests
 import settings
-import soundcloud
 import traceback
 import logging
 import numpy as np
@@ -15,55 +16,30 @@ requests_log = logging.getLogger('requests')
 requests_log.setLevel(logging.WARNING)
 
 from pychedelic import Sound
+from downloads import downloader
 
 
 def get_sound():
     """
-    Downloads a random sound from soundcloud, saves it and returns 
-    the filename and the sound length in seconds.
+    Returns a random sound downloaded from soundcloud : the track id,
+    the filename and the sound length in seconds. If the setting `debug_sounds`
+    is True, sounds are taken in turn from the `mp3s` in `app_root/downloads/` instead.
     """
-    global count
-    count = (count + 1) % len(mp3s)
-    return random.randint(0, 100000), '/home/spiq/versificator/downloads/' + mp3s[count], 120.0
+    if getattr(settings, 'debug_sounds', False):
+        global count
+        with count_lock:
+            count = (count + 1) % len(mp3s)
+            filename = mp3s[count]
+        return int(os.path.splitext(filename)[0]), settings.app_root + 'downloads/' + filename, 120.0
+    return downloader.get()
 
-    #return random.randint(0, 100000), '/home/spiq/versificator/downloads/54691.mp3', 60
-    # create a client object with your app credentials
-    client = soundcloud.Client(client_id='YOUR_CLIENT_ID')
-    track, resp = None, None
-    while (True):
-        # Get a random track
-        while (True):
-            track_id = random.randint(0, 100000)
-            try:
-                track = client.get('/tracks/%s' % track_id)
-            except requests.exceptions.HTTPError as exc:
-                if exc.response.status_code != 404: logger.error(exc)
-                else: logger.debug('%s - %s' % (exc, track_id))
-                continue
-            else: break
 
-        # Downloading track.
-        # We don't want too long tracks because of memory pbs.
-        sound_length = track.duration
-        if sound_length > 60 * 5000: continue
-        if not hasattr(track, 'stream_url'): continue
-        track_stream = client.get(track.stream_url, allow_redirects=False)
-        logger.info('downloading track %s' % track.stream_url)
-        resp = requests.get(track_stream.location)
-        if resp.status_code == 200:
-            filename = settings.app_root + 'downloads/%s.mp3' % track_id
-            logger.info('saving track to %s' % filename)
-            try:
-                with open(filename, 'wb') as fd:
-                    for chunk in resp.iter_content(64 * 1024):
-                        fd.write(chunk)
-            except Exception as exc:
-                logger.error('file download failed : %s' % exc)
-                continue
-        else:
-            logger.error('tried to download track, but got %s' % resp)
-            continue
-        return track_id, filename, sound_length / 1000.0
+def release_sound(filename):
+    """
+    Tells that the sound returned by `get_sound` is not needed anymore.
+    """
+    if getattr(settings, 'debug_sounds', False): return
+    downloader.release(filename)
 
 
 def euclidian_distance(a, b):
@@ -74,19 +50,68 @@ def loop_distance(loop_infos1, loop_infos2):
     """
     Simple measure of the timbral distance between end of loop1 and start of loop2.
     """
-    return euclidian_distance(loop_infos1['timbre_start'], loop_infos2['timbre_end'])
+    return euclidian_distance(loop_infos1.timbre_start, loop_infos2.timbre_end)
+
+
+class OSCSender(object):
+    """
+    Sends OSC messages to the Pd patch through a single long-lived client,
+    shared between all threads. Messages sent by a thread inside a `bundle()`
+    block are sent together as one OSC bundle when the block exits.
+    """
+
+    def __init__(self, address=('localhost', 9001)):
+        self.address = address
+        self._client = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def send(self, address, *args):
+        msg = OSC.OSCMessage(address)
+        for arg in args:
+            msg.append(arg)
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None: pending.append(msg)
+        else: self._send(msg)
+
+    @contextlib.contextmanager
+    def bundle(self):
+        if getattr(self._local, 'pending', None) is not None:
+            yield
+            return
+        self._local.pending = []
+        try:
+            yield
+        finally:
+            pending, self._local.pending = self._local.pending, None
+        if len(pending) == 1: self._send(pending[0])
+        elif pending:
+            bundle = OSC.OSCBundle()
+            for msg in pending: bundle.append(msg)
+            self._send(bundle)
+
+    def _send(self, msg):
+        with self._lock:
+            if self._client is None:
+                self._client = OSC.OSCClient()
+                self._client.connect(self.address)
+            try:
+                self._client.send(msg)
+            except OSC.OSCClientError:
+                # The client is recreated on next send
+                self._client.close()
+                self._client = None
+                raise
+
+sender = OSCSender()
 
 
 def send_msg(address, *args):
-    client = OSC.OSCClient()
-    client.connect(('localhost', 9001))
-    msg = OSC.OSCMessage(address)
-    for arg in args:
-        msg.append(arg)
-    client.send(msg)
+    sender.send(address, *args)
 
 # DEBUGGING
 count = -1
+count_lock = threading.Lock()
 mp3s = [
 '14526.mp3',
  '67471.mp3',
@@ -0,0 +1,195 @@
+"""
+Scraping jobs, and the engine running them in a pool of processes.
+The jobs do all the CPU-heavy work (decoding, analysis, slicing, encoding),
+and only return the small dicts describing what they saved to disk.
+"""
+import random
+import time
+import gc
+import multiprocessing
+import logging
+logger = logging.getLogger('versificator')
+
+import numpy as np
+
+import settings
+from sound import Sound, Track, loop_bars
+from cache import AnalysisCache
+from stretch import stretch, tempo_length
+from shm import write_slot
+from metrics import metrics
+
+analysis_cache = AnalysisCache()
+
+
+def scrape_loops(track_id, filename, sound_length, loop_paths, sample_length):
+    """
+    Extracts loops from the track saved in `filename`, saves them to `loop_paths`,
+    and returns the list of their infos. At most one loop per path is extracted.
+    The whole track is analysed once. If `settings.analysis_mode` is 'track', its
+    best bars are taken. Otherwise ('windows', the default), loops are taken from
+    random samples of `sample_length` seconds, sliced from the track's analysis.
+    """
+    loops_infos = []
+    whole_track = getattr(settings, 'analysis_mode', 'windows') == 'track'
+
+    # Check if the sound is long enough, and if yes we extract some loops from it.
+    # TODO: make this less restrictive to waste a bit less
+    if not whole_track and sound_length <= 2 * sample_length: return loops_infos
+
+    def save_loop(offset, bar_infos):
+        # Loops are identified by their position in the track, so
+        # the same loop always has the same id.
+        loop_start = offset + bar_infos['start']
+        loop_id = '%s_%s' % (track_id, int(round(loop_start * 1000)))
+        loop_path = loop_paths[len(loops_infos)]
+        with metrics.timer('to_file_seconds'):
+            loop_length = track.write(loop_start, loop_start + bar_infos['duration'], loop_path)
+        logger.info('loop extracted to %s' % loop_path)
+
+        loops_infos.append(dict(bar_infos, **{
+            'path': loop_path,
+            'length': loop_length,
+            'loop_id': loop_id,
+            'track_id': track_id,
+            'timbre_start': bar_infos['timbre_start'],
+            'timbre_end': bar_infos['timbre_end']
+        }))
+
+    # The track is decoded only once, and all samples are taken from memory.
+    # It is also analysed only once, and the analysis is cached, so scraping
+    # the same track again doesn't cost any analysis.
+    with Track(filename) as track:
+        with metrics.timer('analysis_seconds'):
+            track_analysis = analyse_track(track, track_id)
+
+        if whole_track:
+            with metrics.timer('extract_loops_seconds'):
+                bars_infos = loop_bars(track_analysis, len(loop_paths))
+            for bar_infos in bars_infos: save_loop(0, bar_infos)
+            return loops_infos
+
+        offset = 0
+        upper_limit = sound_length - 2 * sample_length
+        while (offset + 2 * sample_length < upper_limit):
+
+            # Calculate a random offset where the loop will start
+            offset = random.randint(offset, int(min(offset + sound_length * 0.2, upper_limit)))
+
+            # Extracting loops from the sample, whose analysis is sliced from the track's,
+            # and writing them straight from the decoded track
+            with metrics.timer('extract_loops_seconds'):
+                bars_infos = loop_bars(track_analysis.slice(offset, offset + sample_length))
+            for bar_infos in bars_infos:
+                if len(loops_infos) >= len(loop_paths):
+                    offset = upper_limit
+                    break
+                save_loop(offset, bar_infos)
+
+            # Increment values for next loop
+            offset += sample_length
+    return loops_infos
+
+
+def analyse_track(track, track_id):
+    """
+    Returns the analysis of the whole `track`, from the cache if it is there.
+    The track is wrapped in a `Sound` only if it must be analysed. Whole-track
+    analyses are keyed by the decoded length, like in `batch.extract_batch`.
+    """
+    analysis = analysis_cache.get(track_id, 0, track.length)
+    if analysis is not None: return analysis
+    sound = track.window(0, track.length)
+    analysis = sound.analyse()
+    analysis_cache.put(analysis, track_id, 0, track.length)
+    del sound
+    gc.collect()
+    return analysis
+
+
+def scrape_pad(track_id, pad_path, pad_length, new_pad_path):
+    """
+    Takes the beginning of the track saved in `pad_path`, removes the beats
+    from it, saves the result to `new_pad_path` and returns the pad infos.
+    """
+    with metrics.timer('decode_seconds'):
+        sound = Sound.from_file(pad_path, end=min(30, pad_length))
+    sound = sound.remove_beats(fade=0.01)
+    with metrics.timer('to_file_seconds'):
+        sound.to_file(new_pad_path)
+    logger.info('pad extracted to %s' % new_pad_path)
+    return {
+        'path': new_pad_path,
+        'pad_id': '%s' % (track_id)
+    }
+
+
+def render_loop(path, rendered_path, loop_tempo, required_tempo, fade_in=0.002, fade_out=0.002, in_place=False):
+    """
+    Time-stretches the loop saved in `path` so that it fits `required_tempo`, fades it,
+    saves the result to `rendered_path` and returns its length in seconds.
+    If `in_place` is True, `rendered_path` is a shared memory slot, written with `write_slot`.
+    """
+    loop = Sound.from_file(path)
+    required_length = tempo_length(loop.length, loop_tempo, required_tempo)
+    with metrics.timer('stretch_seconds'):
+        frames = stretch(loop.values, loop.sample_rate, required_length)
+    loop = Sound(frames, sample_rate=loop.sample_rate).fade(in_dur=fade_in, out_dur=fade_out)
+    with metrics.timer('to_file_seconds'):
+        if in_place: return write_slot(rendered_path, loop.values, loop.sample_rate)
+        loop.to_file(rendered_path)
+    return loop.length
+
+
+def _recorded_job(job, *args):
+    """
+    Runs `job(*args)` and returns its result, with the metrics observed meanwhile.
+    """
+    with metrics.recording() as recorded:
+        result = job(*args)
+    return result, recorded
+
+
+def _init_process():
+    # Forked processes all inherit the same random state
+    random.seed()
+    np.random.seed()
+
+
+class ScrapingEngine(object):
+    """
+    Runs scraping jobs in a pool of `processes` processes, so that they
+    don't hold the GIL of the main process. Before `start` is called,
+    jobs are run in the calling thread.
+    """
+
+    def __init__(self, processes=None):
+        if processes is None:
+            processes = getattr(settings, 'scraper_processes', None) or multiprocessing.cpu_count()
+        self.processes = processes
+        self._pool = None
+
+    def start(self):
+        """
+        Starts the processes. This should be called before starting any thread, because
+        the processes are forked and a lock held by another thread would stay locked
+        in them forever. The handler threads of the pool of an engine already started
+        are the exception : they only lock that pool's queues, which the processes
+        of the other engines never use. `multiprocessing` itself forks processes
+        to replace the dead ones while those threads are running.
+        """
+        self._pool = multiprocessing.Pool(self.processes, initializer=_init_process)
+
+    def run(self, job, *args):
+        """
+        Runs `job(*args)` in one of the processes, waits for it and returns its result.
+        """
+        if self._pool is None: return job(*args)
+        # Waiting with a timeout, otherwise the wait cannot be interrupted
+        result, recorded = self._pool.apply_async(_recorded_job, (job,) + args).get(60 * 60 * 24)
+        metrics.merge(recorded)
+        return result
+
+engine = ScrapingEngine()
+# Renderings have their own processes, so they never wait behind the long scraping jobs
+render_engine = ScrapingEngine(getattr(settings, 'render_processes', 1))